@@ -0,0 +1,96 @@
+""":mod:`tests.stub` --- Stand-in provider
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+"""
+import socket
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+__all__ = 'StubServer',
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+class StubServer(object):
+    """Serves canned responses on localhost, and records the requests it
+    got.  A route is a function that takes the request and returns
+    a triple of status, headers and body, or a fixed response.
+
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                server._respond(self)
+
+            do_POST = do_GET
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{0}'.format(self.httpd.server_port)
+        thread = threading.Thread(target=self.httpd.serve_forever,
+                                  kwargs={'poll_interval': 0.01})
+        thread.daemon = True
+        thread.start()
+
+    def route(self, path, body=b'', status=200, headers=None, delay=0):
+        """Serves a fixed response for the ``path``, after ``delay``
+        seconds.
+
+        """
+        def respond(request):
+            time.sleep(delay)
+            return status, headers or {}, body
+        self.routes[path] = respond
+
+    def hits(self, path):
+        """The number of requests to the ``path``."""
+        with self._lock:
+            return sum(1 for r in self.requests if r['path'] == path)
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _respond(self, handler):
+        path = handler.path.split('?', 1)[0]
+        length = int(handler.headers.get('Content-Length') or 0)
+        request = {'method': handler.command,
+                   'path': path,
+                   'headers': handler.headers,
+                   'body': handler.rfile.read(length)}
+        with self._lock:
+            self.requests.append(request)
+        respond = self.routes.get(path)
+        if respond is None:
+            status, headers, body = 404, {}, b''
+        else:
+            status, headers, body = respond(request)
+        try:
+            handler.send_response(status)
+            for name, value in headers.items():
+                handler.send_header(name, value)
+            handler.send_header('Content-Length', str(len(body)))
+            handler.end_headers()
+            handler.wfile.write(body)
+        except socket.error:
+            # The client has given up waiting
+            pass
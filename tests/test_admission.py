@@ -0,0 +1,128 @@
+import json
+import threading
+import time
+import unittest
+
+from wsgioauth2 import (AccessToken, AdmissionController, Service,
+                        WSGIMiddleware)
+
+from .stub import StubServer
+from .wsgi import call
+
+
+def wait_until(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.005)
+
+
+class AdmissionControllerTest(unittest.TestCase):
+
+    def test_reject_immediately(self):
+        controller = AdmissionController(1)
+        self.assertTrue(controller.acquire())
+        self.assertFalse(controller.acquire())
+        controller.release()
+        self.assertTrue(controller.acquire())
+        self.assertEqual({'active': 1, 'waiting': 0, 'admitted': 2,
+                          'rejected': 1, 'timed_out': 0},
+                         controller.stats())
+
+    def test_queue(self):
+        controller = AdmissionController(1, max_queue=1, queue_timeout=5)
+        self.assertTrue(controller.acquire())
+        results = []
+        waiter = threading.Thread(
+            target=lambda: results.append(controller.acquire())
+        )
+        waiter.start()
+        wait_until(lambda: controller.stats()['waiting'] == 1)
+        # The queue is full
+        self.assertFalse(controller.acquire())
+        controller.release()
+        waiter.join()
+        self.assertEqual([True], results)
+        self.assertEqual({'active': 1, 'waiting': 0, 'admitted': 2,
+                          'rejected': 1, 'timed_out': 0},
+                         controller.stats())
+
+    def test_queue_timeout(self):
+        controller = AdmissionController(1, max_queue=1, queue_timeout=0.05)
+        self.assertTrue(controller.acquire())
+        started = time.time()
+        self.assertFalse(controller.acquire())
+        self.assertGreaterEqual(time.time() - started, 0.04)
+        stats = controller.stats()
+        self.assertEqual(1, stats['timed_out'])
+        self.assertEqual(1, stats['rejected'])
+        self.assertEqual(0, stats['waiting'])
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            AdmissionController(0)
+        with self.assertRaises(ValueError):
+            AdmissionController(1, max_queue=-1)
+        with self.assertRaises(TypeError):
+            AdmissionController(1.5)
+
+
+class MiddlewareAdmissionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer()
+        self.server.route('/token', json.dumps({
+            'access_token': 'token'
+        }).encode('utf-8'), headers={'Content-Type': 'application/json'})
+        service = Service(self.server.url + '/authorize',
+                          self.server.url + '/token')
+        self.controller = AdmissionController(1, retry_after=7)
+        self.middleware = WSGIMiddleware(
+            service.make_client('client-id', 'secret'),
+            self.application, b'secret', path='/callback/',
+            login_path='/private', admission_control=self.controller
+        )
+
+    def tearDown(self):
+        self.server.close()
+
+    def application(self, environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'ok']
+
+    def test_callback_admitted(self):
+        response = call(self.middleware, '/callback/',
+                        'code=code&state=/private')
+        self.assertEqual(307, response.status_code)
+        self.assertEqual('/private', response.header('Location'))
+        self.assertIsNotNone(response.header('Set-Cookie'))
+        self.assertEqual(1, self.server.hits('/token'))
+        self.assertEqual(0, self.controller.stats()['active'])
+
+    def test_callback_rejected(self):
+        self.assertTrue(self.controller.acquire())
+        try:
+            response = call(self.middleware, '/callback/', 'code=code')
+        finally:
+            self.controller.release()
+        self.assertEqual(503, response.status_code)
+        self.assertEqual('7', response.header('Retry-After'))
+        self.assertEqual(0, self.server.hits('/token'))
+        self.assertEqual(1, self.controller.stats()['rejected'])
+
+    def test_session_not_limited(self):
+        cookie, _ = self.middleware.dump_session(
+            AccessToken(access_token='token')
+        )
+        self.assertTrue(self.controller.acquire())
+        try:
+            response = call(self.middleware, '/private',
+                            headers={'Cookie': '{0}={1}'.format(
+                                self.middleware.cookie, cookie
+                            )})
+        finally:
+            self.controller.release()
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(b'ok', response.body)
+        self.assertEqual(0, self.controller.stats()['rejected'])
@@ -0,0 +1,200 @@
+import json
+import unittest
+
+from wsgioauth2 import (CircuitBreaker, Client, GitHubService, GoogleService,
+                        Service, TokenCache, WSGIMiddleware)
+
+from .stub import StubServer
+from .wsgi import call
+
+CLIENT_ID = 'client-id'
+
+
+class IntrospectedService(Service):
+
+    def is_user_allowed(self, access_token):
+        # AccessToken.get() is for HTTP requests, not dict.get()
+        return dict.get(access_token, 'username') != 'banned'
+
+
+class BearerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer()
+        self.tokens = {}
+        self.server.routes['/introspect'] = self.introspect
+        self.service = IntrospectedService(
+            self.server.url + '/authorize', self.server.url + '/token',
+            introspection_endpoint=self.server.url + '/introspect'
+        )
+
+    def tearDown(self):
+        self.server.close()
+
+    def introspect(self, request):
+        form = dict(pair.split('=', 1)
+                    for pair in request['body'].decode('ascii').split('&'))
+        claims = self.tokens.get(form['token'], {'active': False})
+        return (200, {'Content-Type': 'application/json'},
+                json.dumps(claims).encode('utf-8'))
+
+    def application(self, environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [environ.get('REMOTE_USER', '').encode('utf-8')]
+
+    def make_middleware(self, client=None, **kwargs):
+        kwargs.setdefault('bearer_cache', TokenCache())
+        return WSGIMiddleware(
+            client or Client(self.service, CLIENT_ID, 'secret'),
+            self.application, b'secret', bearer=True, set_remote_user=True,
+            **kwargs
+        )
+
+    def request(self, middleware, token):
+        return call(middleware, '/',
+                    headers={'Authorization': 'Bearer ' + token})
+
+    def test_valid(self):
+        self.tokens['good'] = {'active': True, 'client_id': CLIENT_ID,
+                               'username': 'user'}
+        middleware = self.make_middleware()
+        for _ in range(3):
+            response = self.request(middleware, 'good')
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(b'user', response.body)
+        # Cached
+        self.assertEqual(1, self.server.hits('/introspect'))
+
+    def test_invalid(self):
+        middleware = self.make_middleware()
+        for _ in range(3):
+            response = self.request(middleware, 'bad')
+            self.assertEqual(401, response.status_code)
+            self.assertIn('invalid_token',
+                          response.header('WWW-Authenticate'))
+        # Negatively cached
+        self.assertEqual(1, self.server.hits('/introspect'))
+
+    def test_negative_ttl(self):
+        middleware = self.make_middleware(
+            bearer_cache=TokenCache(negative_ttl=0)
+        )
+        self.assertEqual(401, self.request(middleware, 'new').status_code)
+        self.tokens['new'] = {'active': True, 'client_id': CLIENT_ID,
+                              'username': 'user'}
+        self.assertEqual(200, self.request(middleware, 'new').status_code)
+        self.assertEqual(2, self.server.hits('/introspect'))
+
+    def test_other_client(self):
+        self.tokens['other'] = {'active': True, 'client_id': 'other',
+                                'username': 'user'}
+        middleware = self.make_middleware()
+        self.assertEqual(401, self.request(middleware, 'other').status_code)
+
+    def test_no_username(self):
+        self.tokens['anonymous'] = {'active': True, 'client_id': CLIENT_ID}
+        middleware = self.make_middleware()
+        response = self.request(middleware, 'anonymous')
+        self.assertEqual(401, response.status_code)
+
+    def test_forbidden(self):
+        self.tokens['banned'] = {'active': True, 'client_id': CLIENT_ID,
+                                 'username': 'banned'}
+        middleware = self.make_middleware()
+        for _ in range(2):
+            self.assertEqual(403,
+                             self.request(middleware, 'banned').status_code)
+        self.assertEqual(1, self.server.hits('/introspect'))
+
+    def test_unavailable(self):
+        self.server.route('/introspect', b'', status=503)
+        middleware = self.make_middleware()
+        response = self.request(middleware, 'good')
+        self.assertEqual(503, response.status_code)
+        self.assertEqual('5', response.header('Retry-After'))
+        # Not cached, so it is validated once the provider is back
+        self.server.routes['/introspect'] = self.introspect
+        self.tokens['good'] = {'active': True, 'client_id': CLIENT_ID,
+                               'username': 'user'}
+        self.assertEqual(200, self.request(middleware, 'good').status_code)
+
+    def test_circuit_open(self):
+        self.server.route('/introspect', b'', status=503)
+        client = Client(self.service, CLIENT_ID, 'secret',
+                        circuit_breaker=CircuitBreaker(failure_threshold=1,
+                                                       recovery_timeout=0.3))
+        middleware = self.make_middleware(client)
+        self.assertEqual(503, self.request(middleware, 'a').status_code)
+        response = self.request(middleware, 'b')
+        self.assertEqual(503, response.status_code)
+        # Rounded up to a whole second
+        self.assertEqual('1', response.header('Retry-After'))
+        self.assertEqual(1, self.server.hits('/introspect'))
+
+    def test_no_token_redirected(self):
+        middleware = self.make_middleware(login_path='/')
+        response = call(middleware, '/')
+        self.assertEqual(307, response.status_code)
+
+
+class BearerServiceTest(unittest.TestCase):
+
+    def application(self, environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [environ.get('REMOTE_USER', '').encode('utf-8')]
+
+    def make_middleware(self, service, **kwargs):
+        return WSGIMiddleware(Client(service, CLIENT_ID, 'secret'),
+                              self.application, b'secret', bearer=True,
+                              **kwargs)
+
+    def test_cannot_validate(self):
+        service = Service('https://provider.example/authorize',
+                          'https://provider.example/token')
+        self.assertFalse(service.can_validate_tokens)
+        with self.assertRaises(ValueError):
+            self.make_middleware(service)
+
+    def test_cannot_check_audience(self):
+        for service in [
+            Service('https://provider.example/authorize',
+                    'https://provider.example/token',
+                    userinfo_endpoint='https://provider.example/userinfo'),
+            GitHubService()
+        ]:
+            self.assertTrue(service.can_validate_tokens)
+            self.assertFalse(service.can_check_token_audience)
+            with self.assertRaises(ValueError):
+                self.make_middleware(service)
+            # Explicitly opted in
+            self.make_middleware(service, bearer_any_audience=True)
+
+    def test_google(self):
+        server = StubServer()
+        self.addCleanup(server.close)
+        server.route('/userinfo', json.dumps({
+            'sub': '1', 'email': 'user@example.com'
+        }).encode('utf-8'))
+        service = GoogleService()
+        service.tokeninfo_endpoint = server.url + '/tokeninfo'
+        service.userinfo_endpoint = server.url + '/userinfo'
+        self.assertTrue(service.can_check_token_audience)
+        middleware = self.make_middleware(service, set_remote_user=True)
+        for audience, status in [(CLIENT_ID, 200), ('other', 401)]:
+            server.route('/tokeninfo', json.dumps({
+                'aud': audience, 'azp': audience, 'sub': '1',
+                'email': 'user@example.com'
+            }).encode('utf-8'))
+            response = call(middleware, '/', headers={
+                'Authorization': 'Bearer ' + audience
+            })
+            self.assertEqual(status, response.status_code)
+            if status == 200:
+                self.assertEqual(b'user@example.com', response.body)
+        # Tokens of other clients are rejected without loading userinfo
+        self.assertEqual(1, server.hits('/userinfo'))
+        server.route('/tokeninfo', b'{"error": "invalid_token"}', status=400)
+        response = call(middleware, '/', headers={
+            'Authorization': 'Bearer expired'
+        })
+        self.assertEqual(401, response.status_code)
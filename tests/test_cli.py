@@ -0,0 +1,81 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from wsgioauth2 import main
+
+from .test_session import make_middleware, make_token
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+
+class InspectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.secret_file = os.path.join(self.directory, 'secret')
+        with open(self.secret_file, 'wb') as f:
+            f.write(b'secret\n')
+        middleware = make_middleware(b'secret')
+        self.valid, _ = middleware.dump_session(make_token(username='alice'))
+        self.expired, _ = middleware.dump_session(
+            make_token(username='bob', expires_in=-60)
+        )
+        forged, _ = make_middleware(b'forged').dump_session(
+            make_token(username='mallory')
+        )
+        self.forged = forged
+        self.log = os.path.join(self.directory, 'access.log')
+        with open(self.log, 'w') as f:
+            f.write('GET / wsgioauth2sess={0}\n'.format(self.valid))
+            f.write('GET / -\n')
+            f.write('GET / wsgioauth2sess={0}\n'.format(self.expired))
+            f.write('GET / wsgioauth2sess={0}\n'.format(self.forged))
+            f.write('GET / wsgioauth2sess=garbage\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def inspect(self, *args):
+        stdout = sys.stdout
+        sys.stdout = output = StringIO()
+        try:
+            status = main(['inspect', '--secret-file', self.secret_file] +
+                          list(args) + [self.log])
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(0, status)
+        return [json.loads(line) for line in output.getvalue().splitlines()]
+
+    def test_reports(self):
+        reports = self.inspect('-j1')
+        self.assertEqual([1, 3, 4, 5], [r['line'] for r in reports])
+        self.assertEqual(set([self.log]), set(r['source'] for r in reports))
+        self.assertEqual(['valid', 'expired', 'bad_signature', 'malformed'],
+                         [r['status'] for r in reports])
+        valid, expired, forged, malformed = reports
+        self.assertEqual('alice', valid['username'])
+        self.assertEqual(self.valid[21:53], valid['session_id'])
+        self.assertIsNone(valid['expires_at'])
+        self.assertEqual('bob', expired['username'])
+        self.assertLess(expired['expires_at'], expired['issued_at'])
+        # Usernames of forged sessions are not trusted
+        self.assertIsNone(forged['username'])
+        self.assertEqual({'status': 'malformed', 'source': self.log,
+                          'line': 5}, malformed)
+
+    def test_max_session_age(self):
+        reports = self.inspect('-j1', '--max-session-age', '0')
+        self.assertEqual('expired', reports[0]['status'])
+
+    def test_jobs(self):
+        single = self.inspect('-j1')
+        for batch_size in '1', '2', '10000':
+            self.assertEqual(single,
+                             self.inspect('-j2', '--batch-size', batch_size))
@@ -0,0 +1,123 @@
+import json
+import socket
+import unittest
+
+try:
+    from urllib2 import HTTPError, Request
+except ImportError:
+    from urllib.error import HTTPError
+    from urllib.request import Request
+
+from wsgioauth2 import CircuitBreaker, CircuitOpenError, Client, Service
+
+from .stub import StubServer
+
+
+class ClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer()
+        self.server.route('/token', json.dumps({
+            'access_token': 'token'
+        }).encode('utf-8'), headers={'Content-Type': 'application/json'})
+        self.service = Service(self.server.url + '/authorize',
+                               self.server.url + '/token')
+
+    def tearDown(self):
+        self.server.close()
+
+    def make_client(self, cls=Client, **kwargs):
+        kwargs.setdefault('timeout', (1, 0.2))
+        client = cls(self.service, 'client-id', 'secret', **kwargs)
+        client.retry_backoff = client.retry_backoff_max = 0.01
+        return client
+
+    def test_read_timeout(self):
+        self.server.route('/slow', b'{}', delay=1)
+        client = self.make_client(retries=2)
+        with self.assertRaises(EnvironmentError):
+            client.urlopen(self.server.url + '/slow')
+        self.assertEqual(3, self.server.hits('/slow'))
+
+    def test_token_exchange_not_retried_after_sent(self):
+        self.server.route('/token', b'{}', delay=1)
+        client = self.make_client(retries=2)
+        with self.assertRaises(EnvironmentError):
+            client.request_access_token('http://localhost/callback', 'code')
+        # The code can be used only once, so it must not be sent again
+        self.assertEqual(1, self.server.hits('/token'))
+
+    def test_connect_error_retried(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        url = 'http://127.0.0.1:{0}/token'.format(sock.getsockname()[1])
+        sock.close()
+        attempts = []
+        client = self.make_client(retries=2)
+        opener = client.opener
+
+        class CountingOpener(object):
+
+            def open(self, *args, **kwargs):
+                attempts.append(args)
+                return opener.open(*args, **kwargs)
+
+        client._opener = CountingOpener()
+        with self.assertRaises(EnvironmentError):
+            client.urlopen(Request(url, data=b'code=code'))
+        self.assertEqual(3, len(attempts))
+
+    def test_transient_error_retried(self):
+        statuses = [503, 503, 200]
+
+        def respond(request):
+            return statuses.pop(0), {}, b'{}'
+        self.server.routes['/flaky'] = respond
+        client = self.make_client(retries=2)
+        response = client.urlopen(self.server.url + '/flaky')
+        self.assertEqual(200, response.getcode())
+        self.assertEqual(3, self.server.hits('/flaky'))
+
+    def test_client_error_not_retried(self):
+        self.server.route('/missing', b'', status=404)
+        client = self.make_client(retries=2)
+        with self.assertRaises(HTTPError):
+            client.urlopen(self.server.url + '/missing')
+        self.assertEqual(1, self.server.hits('/missing'))
+
+    def test_retry_budget(self):
+        class StingyClient(Client):
+            retry_budget_max = 1
+        self.server.route('/down', b'', status=503)
+        client = self.make_client(StingyClient, retries=3)
+        with self.assertRaises(HTTPError):
+            client.urlopen(self.server.url + '/down')
+        self.assertEqual(2, self.server.hits('/down'))
+        with self.assertRaises(HTTPError):
+            client.urlopen(self.server.url + '/down')
+        self.assertEqual(3, self.server.hits('/down'))
+
+    def test_circuit_breaker(self):
+        self.server.route('/down', b'', status=503)
+        breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=60)
+        client = self.make_client(circuit_breaker=breaker)
+        url = self.server.url + '/down'
+        for _ in range(2):
+            with self.assertRaises(HTTPError):
+                client.urlopen(url)
+        self.assertTrue(breaker.is_open(url))
+        with self.assertRaises(CircuitOpenError) as context:
+            client.urlopen(url)
+        self.assertGreater(context.exception.retry_after, 0)
+        self.assertEqual(2, self.server.hits('/down'))
+
+    def test_circuit_breaker_recovers(self):
+        breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=0)
+        client = self.make_client(circuit_breaker=breaker)
+        url = self.server.url + '/flaky'
+        self.server.route('/flaky', b'', status=503)
+        with self.assertRaises(HTTPError):
+            client.urlopen(url)
+        self.server.route('/flaky', b'{}')
+        self.assertEqual(200, client.urlopen(url).getcode())
+        self.assertFalse(breaker.is_open(url))
@@ -0,0 +1,109 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from wsgioauth2 import OpenIDConnectService, Service
+
+from .stub import StubServer
+
+OIDC_PATH = '/.well-known/openid-configuration'
+OAUTH_PATH = '/.well-known/oauth-authorization-server'
+
+
+class DiscoveryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer()
+        self.issuer = self.server.url
+        self.metadata = {
+            'issuer': self.issuer,
+            'authorization_endpoint': self.issuer + '/authorize',
+            'token_endpoint': self.issuer + '/token',
+            'userinfo_endpoint': self.issuer + '/userinfo',
+            'jwks_uri': self.issuer + '/jwks'
+        }
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.cache_dir)
+
+    def serve_metadata(self, path=OIDC_PATH, **headers):
+        self.server.route(path, json.dumps(self.metadata).encode('utf-8'),
+                          headers=dict(headers,
+                                       **{'Content-Type': 'application/json'}))
+
+    def test_discover(self):
+        self.serve_metadata()
+        service = OpenIDConnectService.discover(self.issuer,
+                                                username_claim='email')
+        self.assertEqual(self.issuer + '/authorize',
+                         service.authorize_endpoint)
+        self.assertEqual(self.issuer + '/token', service.access_token_endpoint)
+        self.assertEqual(self.issuer + '/jwks', service.jwks_uri)
+        self.assertEqual(self.issuer, service.issuer)
+        self.assertEqual('email', service.username_claim)
+
+    def test_oauth_authorization_server(self):
+        self.serve_metadata(OAUTH_PATH)
+        service = Service.discover(self.issuer)
+        self.assertEqual(self.issuer + '/token', service.access_token_endpoint)
+        self.assertEqual(1, self.server.hits(OIDC_PATH))
+        self.assertEqual(1, self.server.hits(OAUTH_PATH))
+
+    def test_wrong_issuer(self):
+        self.metadata['issuer'] = 'https://evil.example'
+        self.serve_metadata()
+        with self.assertRaises(ValueError):
+            Service.discover(self.issuer)
+
+    def test_cache(self):
+        self.serve_metadata(**{'Cache-Control': 'max-age=3600'})
+        for _ in range(3):
+            service = Service.discover(self.issuer, cache_dir=self.cache_dir)
+            self.assertEqual(self.issuer + '/token',
+                             service.access_token_endpoint)
+        self.assertEqual(1, self.server.hits(OIDC_PATH))
+        # The cache survives the server, like it does a restart
+        self.server.routes.clear()
+        Service.discover(self.issuer, cache_dir=self.cache_dir)
+
+    def test_no_store(self):
+        self.serve_metadata(**{'Cache-Control': 'no-store'})
+        for _ in range(2):
+            Service.discover(self.issuer, cache_dir=self.cache_dir)
+        self.assertEqual(2, self.server.hits(OIDC_PATH))
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+    def test_stale_cache_revalidated(self):
+        body = json.dumps(self.metadata).encode('utf-8')
+
+        def respond(request):
+            if request['headers'].get('If-None-Match') == '"v1"':
+                return 304, {'Cache-Control': 'max-age=3600'}, b''
+            return 200, {'Content-Type': 'application/json',
+                         'Cache-Control': 'no-cache',
+                         'ETag': '"v1"'}, body
+        self.server.routes[OIDC_PATH] = respond
+        Service.discover(self.issuer, cache_dir=self.cache_dir)
+        # The stale entry is used at once, and revalidated in background
+        service = Service.discover(self.issuer, cache_dir=self.cache_dir)
+        self.assertEqual(self.issuer + '/token', service.access_token_endpoint)
+        deadline = time.time() + 5
+        while self.server.hits(OIDC_PATH) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(2, self.server.hits(OIDC_PATH))
+        self.assertEqual('"v1"',
+                         self.server.requests[-1]['headers']['If-None-Match'])
+        # Once revalidated, the entry is fresh again
+        path = os.path.join(self.cache_dir, os.listdir(self.cache_dir)[0])
+        while time.time() < deadline:
+            with open(path) as f:
+                if json.load(f)['expires_at'] > time.time() + 60:
+                    break
+            time.sleep(0.01)
+        Service.discover(self.issuer, cache_dir=self.cache_dir)
+        self.assertEqual(2, self.server.hits(OIDC_PATH))
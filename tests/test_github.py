@@ -0,0 +1,111 @@
+import json
+import unittest
+
+try:
+    from urllib2 import Request
+    from urlparse import urlsplit, urlunsplit
+except ImportError:
+    from urllib.parse import urlsplit, urlunsplit
+    from urllib.request import Request
+
+from wsgioauth2 import AccessToken, Client, GitHubService
+
+from .stub import StubServer
+
+
+class StubClient(Client):
+    """Sends the requests to api.github.com to the stand-in server."""
+
+    server = None
+
+    def urlopen(self, request):
+        if not isinstance(request, Request):
+            request = Request(request)
+        url = urlsplit(request.get_full_url())
+        stub = urlsplit(self.server.url)
+        url = urlunsplit((stub.scheme, stub.netloc) + tuple(url[2:]))
+        request = Request(url, data=request.data,
+                          headers=dict(request.header_items()))
+        return super(StubClient, self).urlopen(request)
+
+
+def json_response(data, status=200):
+    def respond(request):
+        return (status, {'Content-Type': 'application/json'},
+                json.dumps(data).encode('utf-8'))
+    return respond
+
+
+class GitHubServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer()
+        self.server.routes['/user'] = json_response({'login': 'octocat',
+                                                     'name': 'Octocat'})
+        self.server.routes['/user/orgs'] = json_response([{'login': 'org1'}])
+
+    def tearDown(self):
+        self.server.close()
+
+    def authenticate(self, service):
+        client = StubClient(service, 'client-id', 'secret')
+        client.server = self.server
+        access_token = AccessToken(access_token='token')
+        access_token.client = client
+        service.load_username(access_token)
+        allowed = service.is_user_allowed(access_token)
+        return access_token, allowed
+
+    def test_graphql(self):
+        self.server.routes['/graphql'] = json_response({'data': {
+            'viewer': {'login': 'octocat', 'name': 'Octocat'},
+            'o0': None,
+            'o1': {'viewerIsAMember': True}
+        }})
+        service = GitHubService(allowed_orgs=['missing', 'org1'],
+                                graphql=True)
+        access_token, allowed = self.authenticate(service)
+        self.assertEqual('octocat', access_token['username'])
+        self.assertEqual('Octocat', access_token['name'])
+        self.assertTrue(allowed)
+        # A single query feeds both
+        self.assertEqual(1, self.server.hits('/graphql'))
+        self.assertEqual(0, self.server.hits('/user'))
+        self.assertEqual(0, self.server.hits('/user/orgs'))
+        request = self.server.requests[0]
+        self.assertEqual('bearer token', request['headers']['Authorization'])
+        body = json.loads(request['body'].decode('utf-8'))
+        self.assertEqual({'o0': 'missing', 'o1': 'org1'}, body['variables'])
+
+    def test_graphql_not_member(self):
+        self.server.routes['/graphql'] = json_response({'data': {
+            'viewer': {'login': 'octocat', 'name': None},
+            'o0': {'viewerIsAMember': False}
+        }})
+        service = GitHubService(allowed_orgs='org2', graphql=True)
+        access_token, allowed = self.authenticate(service)
+        self.assertEqual('', access_token['name'])
+        self.assertFalse(allowed)
+        self.assertEqual(1, self.server.hits('/graphql'))
+
+    def test_graphql_rejected(self):
+        for respond in [json_response({'message': 'Forbidden'}, 403),
+                        json_response({'data': None, 'errors': [{}]})]:
+            del self.server.requests[:]
+            self.server.routes['/graphql'] = respond
+            service = GitHubService(allowed_orgs=['org1'], graphql=True)
+            access_token, allowed = self.authenticate(service)
+            self.assertEqual('octocat', access_token['username'])
+            self.assertTrue(allowed)
+            # Falls back to the REST API
+            self.assertEqual(1, self.server.hits('/user'))
+            self.assertEqual(1, self.server.hits('/user/orgs'))
+
+    def test_rest(self):
+        service = GitHubService(allowed_orgs=['org2'])
+        access_token, allowed = self.authenticate(service)
+        self.assertEqual('octocat', access_token['username'])
+        self.assertFalse(allowed)
+        self.assertEqual(0, self.server.hits('/graphql'))
+        self.assertEqual(1, self.server.hits('/user'))
+        self.assertEqual(1, self.server.hits('/user/orgs'))
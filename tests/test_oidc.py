@@ -0,0 +1,204 @@
+import base64
+import binascii
+import hashlib
+import json
+import random
+import time
+import unittest
+
+from wsgioauth2 import (AccessToken, Client, IDTokenError,
+                        OpenIDConnectService)
+
+from .stub import StubServer
+
+ISSUER = 'https://issuer.example'
+CLIENT_ID = 'client-id'
+
+_SHA256_PREFIX = binascii.unhexlify('3031300d060960864801650304020105000420')
+_SMALL_PRIMES = [p for p in range(3, 1000)
+                 if all(p % d for d in range(2, int(p ** 0.5) + 1))]
+
+
+def _is_probable_prime(n, rounds=32):
+    if any(n % p == 0 for p in _SMALL_PRIMES):
+        return n in _SMALL_PRIMES
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+    for _ in range(rounds):
+        x = pow(random.randrange(2, n - 1), d, n)
+        if x in (1, n - 1):
+            continue
+        for _ in range(s - 1):
+            x = pow(x, 2, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def _make_prime(bits):
+    while True:
+        n = random.getrandbits(bits) | (3 << (bits - 2)) | 1
+        if _is_probable_prime(n):
+            return n
+
+
+def _mod_inverse(a, m):
+    x0, x1, r0, r1 = 1, 0, a, m
+    while r1:
+        q = r0 // r1
+        x0, x1 = x1, x0 - q * x1
+        r0, r1 = r1, r0 - q * r1
+    return x0 % m
+
+
+def make_rsa_key(bits=1024, e=65537):
+    """Generates an RSA key pair of the modulus, the public exponent and
+    the private exponent.  It is only for tests: neither the primes nor
+    the generator are suitable for real keys.
+
+    """
+    while True:
+        p = _make_prime(bits // 2)
+        q = _make_prime(bits // 2)
+        phi = (p - 1) * (q - 1)
+        if p != q and phi % e:
+            return p * q, e, _mod_inverse(e, phi)
+
+
+def _b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _int_to_b64url(value):
+    length = (value.bit_length() + 7) // 8
+    return _b64url(binascii.unhexlify('{0:0{1}x}'.format(value, length * 2)))
+
+
+def sign_token(key, header, claims):
+    """Makes an ``RS256`` JSON Web Token signed with the ``key``."""
+    n, _, d = key
+    signing_input = '{0}.{1}'.format(
+        _b64url(json.dumps(header).encode('utf-8')),
+        _b64url(json.dumps(claims).encode('utf-8'))
+    ).encode('ascii')
+    length = (n.bit_length() + 7) // 8
+    digest_info = _SHA256_PREFIX + hashlib.sha256(signing_input).digest()
+    padded = (b'\x00\x01' + b'\xff' * (length - len(digest_info) - 3) +
+              b'\x00' + digest_info)
+    m = int(binascii.hexlify(padded), 16)
+    signature = binascii.unhexlify('{0:0{1}x}'.format(pow(m, d, n),
+                                                      length * 2))
+    return '{0}.{1}'.format(signing_input.decode('ascii'), _b64url(signature))
+
+
+class OpenIDConnectServiceTest(unittest.TestCase):
+
+    key = None
+
+    @classmethod
+    def setUpClass(cls):
+        cls.key = make_rsa_key()
+        cls.other_key = make_rsa_key()
+
+    def setUp(self):
+        n, e, _ = self.key
+        jwks = {'keys': [{'kty': 'RSA', 'kid': 'key-1', 'use': 'sig',
+                          'n': _int_to_b64url(n), 'e': _int_to_b64url(e)}]}
+        self.server = StubServer()
+        self.server.route('/jwks', json.dumps(jwks).encode('utf-8'),
+                          headers={'Content-Type': 'application/json'})
+        self.service = OpenIDConnectService(
+            authorize_endpoint=ISSUER + '/authorize',
+            access_token_endpoint=ISSUER + '/token',
+            issuer=ISSUER,
+            jwks_uri=self.server.url + '/jwks'
+        )
+        self.client = Client(self.service, CLIENT_ID, 'secret')
+
+    def tearDown(self):
+        self.server.close()
+
+    def make_access_token(self, key=None, header=None, **claims):
+        now = int(time.time())
+        payload = {'iss': ISSUER, 'aud': CLIENT_ID, 'sub': 'user-1',
+                   'iat': now, 'exp': now + 300}
+        payload.update(claims)
+        id_token = sign_token(key or self.key,
+                              header or {'alg': 'RS256', 'kid': 'key-1'},
+                              payload)
+        access_token = AccessToken(access_token='token', id_token=id_token)
+        access_token.client = self.client
+        return access_token
+
+    def assert_invalid(self, access_token, message):
+        with self.assertRaises(IDTokenError) as context:
+            self.service.verify_id_token(access_token)
+        self.assertIn(message, str(context.exception))
+
+    def test_valid(self):
+        access_token = self.make_access_token(name='User')
+        claims = self.service.verify_id_token(access_token)
+        self.assertEqual('user-1', claims['sub'])
+        self.service.load_username(access_token)
+        self.assertEqual('user-1', access_token['username'])
+        self.assertEqual('User', access_token['name'])
+        self.assertEqual(1, self.server.hits('/jwks'))
+
+    def test_tampered(self):
+        access_token = self.make_access_token()
+        header, payload, signature = access_token['id_token'].split('.')
+        payload = _b64url(json.dumps({
+            'iss': ISSUER, 'aud': CLIENT_ID, 'sub': 'admin',
+            'exp': int(time.time()) + 300
+        }).encode('utf-8'))
+        access_token['id_token'] = '.'.join([header, payload, signature])
+        self.assert_invalid(access_token, 'signature is invalid')
+
+    def test_signed_by_other_key(self):
+        access_token = self.make_access_token(key=self.other_key)
+        self.assert_invalid(access_token, 'signature is invalid')
+
+    def test_expired(self):
+        access_token = self.make_access_token(exp=int(time.time()) - 3600)
+        self.assert_invalid(access_token, 'expired')
+
+    def test_wrong_audience(self):
+        access_token = self.make_access_token(aud='other-client')
+        self.assert_invalid(access_token, 'not issued for')
+
+    def test_wrong_authorized_party(self):
+        access_token = self.make_access_token(aud=[CLIENT_ID, 'other'],
+                                              azp='other')
+        self.assert_invalid(access_token, 'not issued for')
+
+    def test_wrong_issuer(self):
+        access_token = self.make_access_token(iss='https://evil.example')
+        self.assert_invalid(access_token, 'issuer')
+
+    def test_unknown_key(self):
+        for _ in range(3):
+            access_token = self.make_access_token(
+                header={'alg': 'RS256', 'kid': 'key-2'}
+            )
+            self.assert_invalid(access_token, 'unknown id_token key')
+        # Unknown keys don't make it download the key set every time
+        self.assertEqual(1, self.server.hits('/jwks'))
+
+    def test_unsupported_algorithm(self):
+        access_token = self.make_access_token(
+            header={'alg': 'none', 'kid': 'key-1'}
+        )
+        self.assert_invalid(access_token, 'unsupported')
+
+    def test_not_object(self):
+        access_token = self.make_access_token(header=[1])
+        self.assert_invalid(access_token, 'malformed')
+
+    def test_no_client(self):
+        access_token = self.make_access_token()
+        access_token.client = None
+        self.assert_invalid(access_token, 'AccessToken.client')
@@ -0,0 +1,142 @@
+import time
+import unittest
+
+from wsgioauth2 import (AccessToken, Client, RateLimitTracker, ResponseCache,
+                        Service)
+
+from .stub import StubServer
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer()
+        self.version = 'v1'
+        self.remaining = 100
+        self.server.routes['/resource'] = self.respond
+        service = Service(self.server.url + '/authorize',
+                          self.server.url + '/token')
+        self.client = Client(service, 'client-id', 'secret',
+                             response_cache=ResponseCache())
+        self.access_token = AccessToken(access_token='token')
+        self.access_token.client = self.client
+        self.url = self.server.url + '/resource'
+
+    def tearDown(self):
+        self.server.close()
+
+    def respond(self, request):
+        headers = {'ETag': '"{0}"'.format(self.version),
+                   'X-RateLimit-Limit': '100',
+                   'X-RateLimit-Remaining': str(self.remaining),
+                   'X-RateLimit-Reset': str(int(time.time()) + 3600)}
+        if request['headers'].get('If-None-Match') == headers['ETag']:
+            return 304, headers, b''
+        return 200, headers, self.version.encode('ascii')
+
+    def get(self):
+        response = self.access_token.get(self.url)
+        try:
+            return response.getcode(), response.read()
+        finally:
+            response.close()
+
+    def test_not_modified(self):
+        self.assertEqual((200, b'v1'), self.get())
+        self.assertEqual((200, b'v1'), self.get())
+        self.assertEqual(2, self.server.hits('/resource'))
+        first, second = self.server.requests
+        self.assertIsNone(first['headers'].get('If-None-Match'))
+        self.assertEqual('"v1"', second['headers'].get('If-None-Match'))
+        self.assertEqual(1, len(self.client.response_cache))
+
+    def test_modified(self):
+        self.assertEqual((200, b'v1'), self.get())
+        self.version = 'v2'
+        self.assertEqual((200, b'v2'), self.get())
+        self.assertEqual((200, b'v2'), self.get())
+        self.assertEqual('"v2"',
+                         self.server.requests[-1]['headers']['If-None-Match'])
+
+    def test_no_validators(self):
+        self.server.route('/resource', b'body')
+        for _ in range(2):
+            self.assertEqual((200, b'body'), self.get())
+        self.assertEqual(0, len(self.client.response_cache))
+        self.assertIsNone(
+            self.server.requests[-1]['headers'].get('If-None-Match')
+        )
+
+    def test_rate_limit_low(self):
+        self.remaining = 5
+        self.assertEqual((200, b'v1'), self.get())
+        self.assertTrue(self.client.rate_limits.is_low(self.url))
+        # Served from the cache without a request
+        self.version = 'v2'
+        self.assertEqual((200, b'v1'), self.get())
+        self.assertEqual(1, self.server.hits('/resource'))
+
+    def test_token_not_in_cache_key(self):
+        self.get()
+        key = ResponseCache.key(self.url + '?access_token=token')
+        self.assertIsNotNone(self.client.response_cache.get(key))
+        self.assertEqual(32, len(key))
+
+    def test_lru(self):
+        cache = ResponseCache(max_size=2)
+        headers = {'ETag': '"x"'}
+        for key in b'a', b'b':
+            cache.set(key, key, headers)
+        cache.get(b'a')
+        cache.set(b'c', b'c', headers)
+        self.assertIsNone(cache.get(b'b'))
+        self.assertIsNotNone(cache.get(b'a'))
+        self.assertEqual(2, len(cache))
+
+
+class RateLimitTrackerTest(unittest.TestCase):
+
+    def headers(self, remaining, reset=3600, resource=None):
+        headers = {'X-RateLimit-Limit': '5000',
+                   'X-RateLimit-Remaining': str(remaining),
+                   'X-RateLimit-Reset': str(int(time.time()) + reset)}
+        if resource is not None:
+            headers['X-RateLimit-Resource'] = resource
+        return headers
+
+    def test_budget(self):
+        tracker = RateLimitTracker()
+        url = 'https://api.example.com/user'
+        self.assertIsNone(tracker.budget(url))
+        self.assertFalse(tracker.is_low(url))
+        tracker.update(url, self.headers(4000))
+        self.assertEqual(4000, tracker.budget(url)['remaining'])
+        self.assertFalse(tracker.is_low(url))
+        tracker.update(url, self.headers(400))
+        self.assertTrue(tracker.is_low(url))
+        # Endpoints of the host share the budget
+        tracker.update('https://api.example.com/user/orgs',
+                       self.headers(4000))
+        self.assertFalse(tracker.is_low(url))
+        self.assertFalse(tracker.is_low('https://other.example.com/'))
+
+    def test_reset(self):
+        tracker = RateLimitTracker()
+        url = 'https://api.example.com/user'
+        tracker.update(url, self.headers(0, reset=-1))
+        self.assertEqual(5000, tracker.budget(url)['remaining'])
+        self.assertFalse(tracker.is_low(url))
+
+    def test_resources(self):
+        tracker = RateLimitTracker()
+        rest = 'https://api.example.com/user'
+        graphql = 'https://api.example.com/graphql'
+        tracker.update(rest, self.headers(10, resource='core'))
+        tracker.update(graphql, self.headers(4000, resource='graphql'))
+        self.assertTrue(tracker.is_low(rest))
+        self.assertFalse(tracker.is_low(graphql))
+
+    def test_no_headers(self):
+        tracker = RateLimitTracker()
+        tracker.update('https://api.example.com/', {})
+        self.assertIsNone(tracker.budget('https://api.example.com/'))
@@ -0,0 +1,112 @@
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+import warnings
+
+from wsgioauth2 import RevocationList, Service, WSGIMiddleware
+
+
+class RevocationListTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'revoked')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_memory(self):
+        revoked = RevocationList(capacity=1000)
+        session_id = uuid.uuid4().hex
+        self.assertNotIn(session_id, revoked)
+        revoked.add(session_id)
+        self.assertIn(session_id, revoked)
+        self.assertNotIn(uuid.uuid4().hex, revoked)
+        self.assertEqual(1, len(revoked))
+
+    def test_file(self):
+        revoked = RevocationList(capacity=1000, path=self.path)
+        other = RevocationList(capacity=1000, path=self.path)
+        session_id = uuid.uuid4().hex
+        revoked.add(session_id)
+        self.assertIn(session_id, other)
+        self.assertIn(session_id, RevocationList(capacity=1000,
+                                                 path=self.path))
+
+    def test_incompatible_file(self):
+        RevocationList(capacity=1000, path=self.path)
+        with self.assertRaises(ValueError):
+            RevocationList(capacity=2000, path=self.path)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'os.fork() is unavailable')
+    def test_forked_writers(self):
+        # Made before forking like in a preloaded application, so that
+        # the workers inherit the open file
+        revoked = RevocationList(capacity=10000, path=self.path)
+        workers = 4
+        count = 2000
+        ids = [[uuid.uuid4().hex for _ in range(count)]
+               for _ in range(workers)]
+        pids = []
+        for worker, worker_ids in enumerate(ids):
+            pid = os.fork()
+            if pid == 0:  # pragma: no cover
+                status = 0
+                try:
+                    others = ids[(worker + 1) % workers]
+                    for session_id, other_id in zip(worker_ids, others):
+                        revoked.add(session_id)
+                        if session_id not in revoked:
+                            status = 1
+                        # Reads what the other workers have written
+                        other_id in revoked
+                finally:
+                    os._exit(status)
+            pids.append(pid)
+        for pid in pids:
+            self.assertEqual(0, os.waitpid(pid, 0)[1])
+        fresh = RevocationList(capacity=10000, path=self.path)
+        self.assertEqual(workers * count, len(fresh))
+        for worker_ids in ids:
+            for session_id in worker_ids:
+                self.assertIn(session_id, fresh)
+                self.assertIn(session_id, revoked)
+
+
+class MiddlewareRevocationTest(unittest.TestCase):
+
+    def call(self, middleware, multiprocess):
+        environ = {'PATH_INFO': '/', 'QUERY_STRING': '',
+                   'HTTP_HOST': 'localhost', 'wsgi.url_scheme': 'http',
+                   'wsgi.multiprocess': multiprocess}
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            middleware(environ, lambda status, headers: None)
+        return [w for w in caught if issubclass(w.category, RuntimeWarning)]
+
+    def make_middleware(self, **kwargs):
+        service = Service('https://provider.example/authorize',
+                          'https://provider.example/token')
+        return WSGIMiddleware(service.make_client('client-id', 'secret'),
+                              lambda environ, start_response: [b''],
+                              b'secret', login_path='/login',
+                              logout_path='/logout', **kwargs)
+
+    def test_warn_in_memory_list_in_multiprocess(self):
+        middleware = self.make_middleware()
+        self.assertEqual([], self.call(middleware, False))
+        self.assertEqual(1, len(self.call(middleware, True)))
+        # Only once
+        self.assertEqual([], self.call(middleware, True))
+
+    def test_file_list_in_multiprocess(self):
+        directory = tempfile.mkdtemp()
+        try:
+            revoked = RevocationList(capacity=1000,
+                                     path=os.path.join(directory, 'revoked'))
+            middleware = self.make_middleware(revocation_list=revoked)
+            self.assertEqual([], self.call(middleware, True))
+        finally:
+            shutil.rmtree(directory)
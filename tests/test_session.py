@@ -0,0 +1,192 @@
+import contextlib
+import time
+import unittest
+
+from wsgioauth2 import (AccessToken, RevocationList, Service, Session,
+                        WSGIMiddleware)
+
+
+@contextlib.contextmanager
+def shifted_time(seconds):
+    """Makes :func:`time.time()` return ``seconds`` later."""
+    original = time.time
+    time.time = lambda: original() + seconds
+    try:
+        yield
+    finally:
+        time.time = original
+
+
+def make_middleware(secret=b'secret', **kwargs):
+    service = Service('https://provider.example/authorize',
+                      'https://provider.example/token')
+    return WSGIMiddleware(service.make_client('client-id', 'secret'),
+                          lambda environ, start_response: [b''],
+                          secret, **kwargs)
+
+
+def make_token(**fields):
+    token = AccessToken(access_token='token', refresh_token='refresh',
+                        scope='openid email')
+    token.update(fields)
+    return token
+
+
+class SessionCookieTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        middleware = make_middleware()
+        value, expires_at = middleware.dump_session(make_token())
+        self.assertEqual(0, expires_at)
+        session = middleware.load_session(value)
+        self.assertIsInstance(session, AccessToken)
+        self.assertEqual('token', session.access_token)
+        self.assertEqual('refresh', session['refresh_token'])
+        self.assertEqual(32, len(session['session_id']))
+
+    def test_new_session_id(self):
+        middleware = make_middleware()
+        first = middleware.load_session(middleware.dump_session(
+            make_token()
+        )[0])
+        second = middleware.load_session(middleware.dump_session(
+            make_token()
+        )[0])
+        self.assertNotEqual(first['session_id'], second['session_id'])
+
+    def test_tampered_header(self):
+        middleware = make_middleware()
+        value, _ = middleware.dump_session(make_token())
+        # The expires-at time, 0 for no expiry
+        tampered = value[:11] + '9999999999' + value[21:]
+        self.assertIsNone(middleware.load_session(tampered))
+        # The session id
+        tampered = value[:21] + 'f' * 32 + value[53:]
+        self.assertIsNone(middleware.load_session(tampered))
+
+    def test_tampered_payload(self):
+        middleware = make_middleware()
+        value, _ = middleware.dump_session(make_token())
+        last = 'A' if value[-1] != 'A' else 'B'
+        self.assertIsNone(middleware.load_session(value[:-1] + last))
+
+    def test_other_secret(self):
+        value, _ = make_middleware().dump_session(make_token())
+        other = make_middleware(secret=b'other')
+        self.assertIsNone(other.load_session(value))
+
+    def test_malformed(self):
+        middleware = make_middleware()
+        for value in '', 'garbage', '2' + 'x' * 200:
+            self.assertIsNone(middleware.load_session(value))
+
+    def test_expired(self):
+        middleware = make_middleware()
+        value, expires_at = middleware.dump_session(make_token(
+            expires_in='3600'
+        ))
+        self.assertAlmostEqual(time.time() + 3600, expires_at, delta=5)
+        self.assertIsNotNone(middleware.load_session(value))
+        with shifted_time(3601):
+            self.assertIsNone(middleware.load_session(value))
+
+    def test_max_session_age(self):
+        middleware = make_middleware(max_session_age=60)
+        value, expires_at = middleware.dump_session(make_token(
+            expires_in=3600
+        ))
+        self.assertAlmostEqual(time.time() + 60, expires_at, delta=5)
+        with shifted_time(61):
+            self.assertIsNone(middleware.load_session(value))
+
+    def test_max_session_age_lowered(self):
+        # Cookies issued before max_session_age was lowered are rejected
+        # even though their own expiry is later
+        value, _ = make_middleware(max_session_age=3600).dump_session(
+            make_token()
+        )
+        middleware = make_middleware(max_session_age=60)
+        self.assertIsNotNone(middleware.load_session(value))
+        with shifted_time(61):
+            self.assertIsNone(middleware.load_session(value))
+
+    def test_revoked(self):
+        revoked = RevocationList(capacity=100)
+        middleware = make_middleware(logout_path='/logout',
+                                     revocation_list=revoked)
+        value, _ = middleware.dump_session(make_token())
+        session = middleware.load_session(value)
+        revoked.add(session['session_id'])
+        self.assertIsNone(middleware.load_session(value))
+
+
+class SessionFieldsTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        middleware = make_middleware(session_fields=['email', 'name'])
+        value, _ = middleware.dump_session(make_token(email='a@example.com'))
+        session = middleware.load_session(value)
+        self.assertIsInstance(session, Session)
+        self.assertEqual('token', session.access_token)
+        self.assertEqual('a@example.com', session['email'])
+        self.assertEqual(32, len(session['session_id']))
+        # Missing fields stay missing, and others are not kept
+        self.assertNotIn('name', session)
+        self.assertNotIn('refresh_token', session)
+        with self.assertRaises(KeyError):
+            session['name']
+
+    def test_smaller(self):
+        token = make_token(email='a@example.com', id_token='x' * 1000)
+        full, _ = make_middleware().dump_session(token)
+        projected, _ = make_middleware(
+            session_fields=['email']
+        ).dump_session(token)
+        self.assertLess(len(projected), len(full) // 2)
+
+    def test_set_remote_user(self):
+        middleware = make_middleware(session_fields=['email'],
+                                     set_remote_user=True)
+        value, _ = middleware.dump_session(make_token(username='user'))
+        self.assertEqual('user', middleware.load_session(value)['username'])
+
+    def test_other_layout(self):
+        value, _ = make_middleware(session_fields=['email']).dump_session(
+            make_token(email='a@example.com')
+        )
+        self.assertIsNone(
+            make_middleware(session_fields=['name']).load_session(value)
+        )
+        self.assertIsNone(make_middleware().load_session(value))
+
+    def test_full_cookie_with_fields(self):
+        # Cookies made before session_fields was set still work
+        value, _ = make_middleware().dump_session(make_token())
+        middleware = make_middleware(session_fields=['email'])
+        self.assertEqual('token', middleware.load_session(value).access_token)
+
+    def test_mapping(self):
+        middleware = make_middleware(session_fields=['email', 'name'])
+        session = middleware.project_session(make_token(email='a@example.com'))
+        self.assertIsInstance(session, Session)
+        self.assertEqual({'access_token': 'token', 'email': 'a@example.com'},
+                         dict(session))
+        self.assertEqual(2, len(session))
+        self.assertEqual(set(['access_token', 'email']), set(session))
+        self.assertEqual(session, {'access_token': 'token',
+                                   'email': 'a@example.com'})
+        self.assertEqual('a@example.com', session['email'])
+        self.assertIn('email', session)
+        self.assertNotIn('name', session)
+        self.assertNotIn('unknown', session)
+        self.assertEqual(sorted(['access_token', 'email']),
+                         sorted(session.keys()))
+        self.assertIn('a@example.com', session.values())
+        self.assertEqual('token', str(session))
+        self.assertIn('a@example.com', repr(session))
+        # Only the fields of the projection can be set
+        session['name'] = 'Name'
+        self.assertEqual('Name', session['name'])
+        with self.assertRaises(KeyError):
+            session['other'] = 'value'
+        self.assertIs(session, middleware.project_session(session))
@@ -0,0 +1,52 @@
+""":mod:`tests.wsgi` --- Calling WSGI applications
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+"""
+__all__ = 'Response', 'call'
+
+
+class Response(object):
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    @property
+    def status_code(self):
+        return int(self.status.split()[0])
+
+    def header(self, name):
+        for key, value in self.headers:
+            if key.lower() == name.lower():
+                return value
+
+
+def call(application, path='/', query_string='', headers=None, **environ):
+    """Calls the WSGI ``application`` with a ``GET`` request to the ``path``
+    on ``http://localhost``, and returns the :class:`Response`.  HTTP
+    ``headers`` are given like ``{'Cookie': 'a=b'}``.
+
+    """
+    environ.update({
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': path,
+        'QUERY_STRING': query_string,
+        'HTTP_HOST': 'localhost',
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'wsgi.url_scheme': 'http',
+    })
+    for name, value in (headers or {}).items():
+        environ['HTTP_' + name.upper().replace('-', '_')] = value
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [status, headers]
+    iterable = application(environ, start_response)
+    try:
+        body = b''.join(iterable)
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
+    return Response(started[0], started[1], body)
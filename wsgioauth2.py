@@ -30,30 +30,25 @@ authenticate via the specific `OAuth 2.0`_ service, e.g., Facebook_, Google_.
 """
 import base64
 import binascii
+import collections
 try:
-    from html import escape as html_escape
+    from collections.abc import Mapping
 except ImportError:
-    from cgi import escape as html_escape
-try:
-    import Cookie
-except ImportError:
-    from http import cookies as Cookie
+    from collections import Mapping
+import errno
 import hashlib
 import hmac
-try:
-    import simplejson as json
-except ImportError:
-    import json
+import io
+import math
 import numbers
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
+import os
+import os.path
 import random
-try:
-    import urllib2
-except ImportError:
-    from urllib import request as urllib2
+import struct
+import sys
+import threading
+import time
+import warnings
 try:
     import urlparse
 except ImportError:
@@ -68,8 +63,55 @@ __license__ = 'MIT License'
 __version__ = '0.2.3'
 __copyright__ = '2011-2020, Hong Minhee'
 
-__all__ = ('AccessToken', 'Client', 'GitHubService', 'GithubService',
-           'Service', 'WSGIMiddleware', 'github', 'google', 'facebook')
+
+class _LazyModule(object):
+    """Stands for a module imported on first use, which then replaces it in
+    the globals of this module.  The first importable of the ``names`` is
+    used.  Heavy modules that not every process needs are imported this
+    way, so that importing :mod:`wsgioauth2` is fast.
+
+    """
+
+    def __init__(self, alias, *names):
+        self._alias = alias
+        self._names = names
+
+    def _load(self):
+        for name in self._names[:-1]:
+            try:
+                __import__(name)
+            except ImportError:
+                continue
+            break
+        else:
+            name = self._names[-1]
+            __import__(name)
+        module = sys.modules[name]
+        globals()[self._alias] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return '<lazy module {0}>'.format(' or '.join(self._names))
+
+
+Cookie = _LazyModule('Cookie', 'Cookie', 'http.cookies')
+html = _LazyModule('html', 'html', 'cgi')
+httplib = _LazyModule('httplib', 'httplib', 'http.client')
+json = _LazyModule('json', 'simplejson', 'json')
+pickle = _LazyModule('pickle', 'cPickle', 'pickle')
+socket = _LazyModule('socket', 'socket')
+tempfile = _LazyModule('tempfile', 'tempfile')
+urllib2 = _LazyModule('urllib2', 'urllib2', 'urllib.request')
+
+__all__ = ('AccessToken', 'AdmissionController', 'CircuitBreaker',
+           'CircuitOpenError', 'Client', 'GitHubService', 'GithubService',
+           'GoogleService', 'IDTokenError', 'OpenIDConnectService',
+           'RateLimitTracker', 'RequestProfiler', 'ResponseCache',
+           'RevocationList', 'Service', 'Session', 'TokenCache',
+           'WSGIMiddleware', 'get_service', 'github', 'google', 'facebook')
 
 
 # Python 3 compatibility
@@ -78,6 +120,185 @@ try:
 except NameError:
     basestring = str
 
+# Python 3.3+ has a clock that is not affected by system time updates
+_clock = getattr(time, 'monotonic', time.time)
+
+# Python 3.3+ can atomically replace an existing file on every platform
+_replace_file = getattr(os, 'replace', os.rename)
+
+
+def _compare_digest(a, b):
+    # Python 2.7.7+ and 3.3+ have hmac.compare_digest()
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(bytearray(a), bytearray(b)):
+        result |= x ^ y
+    return result == 0
+
+
+_compare_digest = getattr(hmac, 'compare_digest', _compare_digest)
+
+
+def _write_file_atomically(path, data):
+    """Writes ``data`` to ``path`` so that concurrent readers, e.g., other
+    worker processes, never see a partially written file.
+
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.wsgioauth2')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        _replace_file(temp_path, path)
+    except Exception:
+        os.unlink(temp_path)
+        raise
+
+
+# Seconds to cache provider metadata without Cache-Control/Expires headers
+_DISCOVERY_DEFAULT_MAX_AGE = 3600
+
+
+def _metadata_urls(issuer):
+    """Lists the well-known urls of the provider metadata of the ``issuer``:
+    OpenID Connect Discovery first, and then OAuth 2.0 Authorization Server
+    Metadata (:rfc:`8414`).
+
+    """
+    url = urlparse.urlsplit(issuer)
+    path = url.path.rstrip('/')
+    return [
+        issuer.rstrip('/') + '/.well-known/openid-configuration',
+        urlparse.urlunsplit((url.scheme, url.netloc,
+                             '/.well-known/oauth-authorization-server' + path,
+                             '', ''))
+    ]
+
+
+def _metadata_expires_at(headers):
+    """Calculates when a metadata response expires from its HTTP cache
+    headers.  Returns :const:`None` if it must not be cached.
+
+    """
+    cache_control = (headers.get('Cache-Control') or '').lower()
+    directives = [d.strip() for d in cache_control.split(',')]
+    if 'no-store' in directives:
+        return None
+    elif 'no-cache' in directives:
+        return time.time()
+    for directive in directives:
+        if directive.startswith('max-age='):
+            try:
+                return time.time() + int(directive[8:])
+            except ValueError:
+                break
+    expires = headers.get('Expires')
+    if expires:
+        from email.utils import mktime_tz, parsedate_tz
+        expires = parsedate_tz(expires)
+        return mktime_tz(expires) if expires else time.time()
+    return time.time() + _DISCOVERY_DEFAULT_MAX_AGE
+
+
+def _fetch_metadata(issuer, timeout, cached=None):
+    """Downloads the provider metadata of the ``issuer``.  If a ``cached``
+    entry is given, it is revalidated with a conditional request.
+
+    """
+    error = None
+    urls = _metadata_urls(issuer)
+    if cached is not None and cached.get('url') in urls:
+        urls.remove(cached['url'])
+        urls.insert(0, cached['url'])
+    for url in urls:
+        request = urllib2.Request(url)
+        request.add_header('Accept', 'application/json')
+        if cached is not None and cached.get('url') == url:
+            if cached.get('etag'):
+                request.add_header('If-None-Match', cached['etag'])
+            if cached.get('last_modified'):
+                request.add_header('If-Modified-Since',
+                                   cached['last_modified'])
+        try:
+            response = urllib2.urlopen(request, timeout=timeout)
+        except urllib2.HTTPError as e:
+            if e.code == 304:
+                entry = dict(cached)
+                entry['expires_at'] = _metadata_expires_at(e.info())
+                return entry
+            elif e.code in (404, 405, 410):
+                error = e
+                continue
+            raise
+        try:
+            metadata = json.loads(response.read().decode('utf-8'))
+            headers = response.info()
+        finally:
+            response.close()
+        if metadata.get('issuer', issuer).rstrip('/') != issuer.rstrip('/'):
+            raise ValueError('the metadata is for the issuer {0!r}, not '
+                             '{1!r}'.format(metadata.get('issuer'), issuer))
+        return {'url': url,
+                'metadata': metadata,
+                'expires_at': _metadata_expires_at(headers),
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified')}
+    raise error
+
+
+def _metadata_cache_path(cache_dir, issuer):
+    filename = hashlib.sha1(issuer.encode('utf-8')).hexdigest() + '.json'
+    return os.path.join(cache_dir, filename)
+
+
+def _read_metadata_cache(path):
+    try:
+        with open(path, 'rb') as f:
+            entry = json.loads(f.read().decode('utf-8'))
+    except (EnvironmentError, ValueError):
+        return None
+    if not isinstance(entry, dict) or 'metadata' not in entry:
+        return None
+    return entry
+
+
+def _write_metadata_cache(path, entry):
+    if entry['expires_at'] is None:
+        return
+    try:
+        _write_file_atomically(path, json.dumps(entry).encode('utf-8'))
+    except EnvironmentError:
+        # The disk cache is only an optimization
+        pass
+
+
+def _refresh_metadata_cache(path, issuer, timeout, cached):
+    try:
+        entry = _fetch_metadata(issuer, timeout, cached)
+    except (EnvironmentError, httplib.HTTPException, ValueError):
+        # Keep serving the stale entry; the next startup will try again
+        return
+    _write_metadata_cache(path, entry)
+
+
+def _is_token_for(claims, client):
+    """Whether the token of the introspection or userinfo ``claims`` is
+    issued to or intended for the ``client``.  Tokens whose claims tell
+    neither are given the benefit of the doubt.
+
+    """
+    client_id = claims.get('client_id', claims.get('azp'))
+    audience = claims.get('aud')
+    if client_id is None and audience is None:
+        return True
+    elif client is None:
+        return False
+    if isinstance(audience, basestring):
+        audience = [audience]
+    return client_id == client.client_id or \
+        client.client_id in (audience or ())
+
 
 class Service(object):
     """OAuth 2.0 service provider e.g. Facebook, Google. It takes
@@ -87,6 +308,20 @@ class Service(object):
     :type authorize_endpoint: :class:`basestring`
     :param access_token_endpoint: api url for getting access token
     :type access_token_endpoint: :class:`basestring`
+    :param introspection_endpoint: optional api url for `token
+                                   introspection`__, used to validate
+                                   bearer tokens
+    :type introspection_endpoint: :class:`basestring`
+    :param userinfo_endpoint: optional api url that returns the user's
+                              claims for a bearer token, used to validate
+                              bearer tokens if there is no
+                              ``introspection_endpoint``
+    :type userinfo_endpoint: :class:`basestring`
+
+    __ https://tools.ietf.org/html/rfc7662
+
+    .. versionadded:: 0.2.3
+       The ``introspection_endpoint`` and ``userinfo_endpoint`` options.
 
     """
 
@@ -96,7 +331,24 @@ class Service(object):
     #: (:class:`basestring`) The API URL for getting access token.
     access_token_endpoint = None
 
-    def __init__(self, authorize_endpoint, access_token_endpoint):
+    #: (:class:`basestring`) The API URL for token introspection.
+    #:
+    #: .. versionadded:: 0.2.3
+    introspection_endpoint = None
+
+    #: (:class:`basestring`) The API URL that returns the user's claims.
+    #:
+    #: .. versionadded:: 0.2.3
+    userinfo_endpoint = None
+
+    #: (:class:`basestring`) The claim of introspection and userinfo
+    #: responses used as the username.
+    #:
+    #: .. versionadded:: 0.2.3
+    username_claim = 'sub'
+
+    def __init__(self, authorize_endpoint, access_token_endpoint,
+                 introspection_endpoint=None, userinfo_endpoint=None):
         def check_endpoint(endpoint):
             if not isinstance(endpoint, basestring):
                 raise TypeError('endpoint must be a string, not ' +
@@ -108,6 +360,12 @@ class Service(object):
             return endpoint
         self.authorize_endpoint = check_endpoint(authorize_endpoint)
         self.access_token_endpoint = check_endpoint(access_token_endpoint)
+        if introspection_endpoint is not None:
+            introspection_endpoint = check_endpoint(introspection_endpoint)
+        self.introspection_endpoint = introspection_endpoint
+        if userinfo_endpoint is not None:
+            userinfo_endpoint = check_endpoint(userinfo_endpoint)
+        self.userinfo_endpoint = userinfo_endpoint
 
     def load_username(self, access_token):
         """Load a username from the service suitable for the REMOTE_USER
@@ -136,6 +394,203 @@ class Service(object):
         """
         return True
 
+    @property
+    def can_validate_tokens(self):
+        """(:class:`bool`) Whether :meth:`validate_token()` works, i.e.,
+        the service has an :attr:`introspection_endpoint` or
+        a :attr:`userinfo_endpoint`, or implements :meth:`load_username()`
+        or :meth:`validate_token()` itself.
+
+        .. versionadded:: 0.2.3
+
+        """
+        return (self.introspection_endpoint is not None or
+                self.userinfo_endpoint is not None or
+                self._overrides('load_username') or
+                self._overrides('validate_token'))
+
+    @property
+    def can_check_token_audience(self):
+        """(:class:`bool`) Whether :meth:`validate_token()` can tell if
+        a token is issued to the client, so that tokens the provider issued
+        to other applications are rejected.  It is true if the service has
+        an :attr:`introspection_endpoint` or implements
+        :meth:`validate_token()` itself.  Userinfo responses and
+        :meth:`load_username()` usually cannot tell it.
+
+        .. versionadded:: 0.2.3
+
+        """
+        return (self.introspection_endpoint is not None or
+                self._overrides('validate_token'))
+
+    def _overrides(self, name):
+        """Whether the class of the service overrides the method of
+        :class:`Service` of the ``name``.
+
+        """
+        method = getattr(type(self), name)
+        base = getattr(Service, name)
+        return getattr(method, '__func__', method) is not \
+            getattr(base, '__func__', base)
+
+    def validate_token(self, access_token):
+        """Check if a bearer token given by an API client is valid, and load
+        its username as :meth:`load_username()` does.  The token is
+        validated through the :attr:`introspection_endpoint`, or the
+        :attr:`userinfo_endpoint`, or :meth:`load_username()` in order,
+        whichever is available.
+
+        .. note::
+
+           If the introspection or userinfo response has ``client_id``,
+           ``aud`` or ``azp``, the token has to be issued to or intended
+           for the client of the ``access_token``.  Userinfo responses
+           usually have none of them, and :meth:`load_username()` cannot
+           tell either, so that tokens issued to other applications of
+           the same provider are accepted as well in these cases (see
+           :attr:`can_check_token_audience`).  Use
+           an :attr:`introspection_endpoint` if the provider has one.
+
+        :param access_token: an :class:`AccessToken` made of the bearer token
+        :returns: whether the token is valid
+        :rtype: :class:`bool`
+
+        .. versionadded:: 0.2.3
+
+        """
+        try:
+            if self.introspection_endpoint is not None:
+                return self._introspect(access_token)
+            elif self.userinfo_endpoint is not None:
+                return self._load_userinfo(access_token)
+            self.load_username(access_token)
+        except urllib2.HTTPError as e:
+            if _is_transient(e):
+                raise
+            return False
+        return True
+
+    def _introspect(self, access_token):
+        form = {'token': access_token.access_token,
+                'token_type_hint': 'access_token'}
+        request = urllib2.Request(self.introspection_endpoint,
+                                  data=urlencode(form).encode('utf-8'))
+        request.add_header('Accept', 'application/json')
+        client = access_token.client
+        if client is not None:
+            credentials = '{0}:{1}'.format(client.client_id,
+                                           client.client_secret)
+            credentials = base64.b64encode(credentials.encode('utf-8'))
+            request.add_header('Authorization',
+                               'Basic ' + credentials.decode('ascii'))
+        response = access_token._urlopen(request)
+        try:
+            claims = json.loads(response.read().decode('utf-8'))
+        finally:
+            response.close()
+        if not claims.get('active') or \
+                not _is_token_for(claims, access_token.client):
+            return False
+        username = claims.get('username', claims.get(self.username_claim))
+        if username is not None:
+            access_token['username'] = username
+        access_token._claims = claims
+        return True
+
+    def _load_userinfo(self, access_token):
+        request = urllib2.Request(self.userinfo_endpoint)
+        request.add_header('Accept', 'application/json')
+        request.add_header('Authorization',
+                           'Bearer ' + access_token.access_token)
+        response = access_token._urlopen(request)
+        try:
+            claims = json.loads(response.read().decode('utf-8'))
+        finally:
+            response.close()
+        if not _is_token_for(claims, access_token.client):
+            return False
+        if self.username_claim in claims:
+            access_token['username'] = claims[self.username_claim]
+        if 'name' in claims:
+            access_token['name'] = claims['name']
+        access_token._claims = claims
+        return True
+
+    @classmethod
+    def discover(cls, issuer, cache_dir=None, timeout=10, **kwargs):
+        r"""Makes a service from the provider metadata of the ``issuer``,
+        published at ``/.well-known/openid-configuration`` (`OpenID Connect
+        Discovery`__) or ``/.well-known/oauth-authorization-server``
+        (:rfc:`8414`).
+
+        If ``cache_dir`` is given, the metadata is cached on disk as long
+        as its ``Cache-Control`` or ``Expires`` header allows, so that
+        worker processes start without waiting for the network once
+        the cache is warm.  A stale entry is still used, and it is
+        revalidated in a background thread for the next startup.
+
+        :param issuer: the issuer url e.g. ``'https://accounts.google.com'``
+        :type issuer: :class:`basestring`
+        :param cache_dir: an optional directory to cache the metadata
+        :type cache_dir: :class:`basestring`
+        :param timeout: seconds to wait for the provider.  default is 10
+        :type timeout: :class:`numbers.Real`
+        :param \*\*kwargs: additional arguments for the constructor.
+                           they take precedence over the metadata
+        :returns: a service for the provider
+        :rtype: :class:`Service`
+
+        __ https://openid.net/specs/openid-connect-discovery-1_0.html
+
+        .. versionadded:: 0.2.3
+
+        """
+        if not isinstance(issuer, basestring):
+            raise TypeError('issuer must be a string, not ' + repr(issuer))
+        elif not issuer.startswith(('http://', 'https://')):
+            raise ValueError('issuer must be a url string, not ' +
+                             repr(issuer))
+        if cache_dir is None:
+            entry = _fetch_metadata(issuer, timeout)
+        else:
+            path = _metadata_cache_path(cache_dir, issuer)
+            entry = _read_metadata_cache(path)
+            if entry is None:
+                entry = _fetch_metadata(issuer, timeout)
+                _write_metadata_cache(path, entry)
+            elif entry.get('expires_at', 0) <= time.time():
+                thread = threading.Thread(
+                    target=_refresh_metadata_cache,
+                    args=(path, issuer, timeout, entry),
+                    name='wsgioauth2-discovery'
+                )
+                thread.daemon = True
+                thread.start()
+        return cls.from_metadata(entry['metadata'], **kwargs)
+
+    @classmethod
+    def from_metadata(cls, metadata, **kwargs):
+        r"""Makes a service from the provider ``metadata``.
+
+        :param metadata: the provider metadata
+        :type metadata: :class:`collections.Mapping`
+        :param \*\*kwargs: additional arguments for the constructor.
+                           they take precedence over the metadata
+        :rtype: :class:`Service`
+
+        .. versionadded:: 0.2.3
+
+        """
+        kwargs.setdefault('authorize_endpoint',
+                          metadata['authorization_endpoint'])
+        kwargs.setdefault('access_token_endpoint', metadata['token_endpoint'])
+        kwargs.setdefault('introspection_endpoint',
+                          metadata.get('introspection_endpoint'))
+        kwargs.setdefault('userinfo_endpoint',
+                          metadata.get('userinfo_endpoint'))
+        return cls(**kwargs)
+
     def make_client(self, client_id, client_secret, **extra):
         """Makes a :class:`Client` for the service.
 
@@ -151,6 +606,35 @@ class Service(object):
         """
         return Client(self, client_id, client_secret, **extra)
 
+    def endpoints(self):
+        """Lists the urls of the provider the client requests, e.g., to
+        open connections to them ahead by :meth:`Client.warmup()`.
+
+        :rtype: :class:`list`
+
+        .. versionadded:: 0.2.3
+
+        """
+        return [endpoint
+                for endpoint in (self.access_token_endpoint,
+                                 self.introspection_endpoint,
+                                 self.userinfo_endpoint)
+                if endpoint is not None]
+
+    def warmup(self, client=None):
+        """Loads what the service needs to handle requests ahead, e.g.,
+        in a post-fork hook of the server.  It does nothing by default.
+
+        :param client: an optional client to make requests through
+        :type client: :class:`Client`
+        :returns: what was loaded
+        :rtype: :class:`dict`
+
+        .. versionadded:: 0.2.3
+
+        """
+        return {}
+
 
 class GitHubService(Service):
     """OAuth 2.0 service provider for GitHub with support for getting the
@@ -160,6 +644,14 @@ class GitHubService(Service):
                          protected application.
     :type allowed_orgs: :class:`basestring`,
                         :class:`collections.Container` of :class:`basestring`
+    :param graphql: Set to True to fetch the username and the membership of
+                    ``allowed_orgs`` in a single GraphQL query, instead of
+                    two REST API calls.  The REST API is still used if
+                    the GraphQL API rejects the query.
+    :type graphql: :class:`bool`
+
+    .. versionadded:: 0.2.3
+       The ``graphql`` option.
 
     .. versionadded:: 0.1.3
        The ``allowed_orgs`` option.
@@ -168,7 +660,12 @@ class GitHubService(Service):
 
     """
 
-    def __init__(self, allowed_orgs=None):
+    #: (:class:`basestring`) The GitHub GraphQL API endpoint.
+    #:
+    #: .. versionadded:: 0.2.3
+    graphql_endpoint = 'https://api.github.com/graphql'
+
+    def __init__(self, allowed_orgs=None, graphql=False):
         super(GitHubService, self).__init__(
             authorize_endpoint='https://github.com/login/oauth/authorize',
             access_token_endpoint='https://github.com/login/oauth/access_token')
@@ -176,6 +673,80 @@ class GitHubService(Service):
         if isinstance(allowed_orgs, basestring):
             allowed_orgs = [allowed_orgs]
         self.allowed_orgs = allowed_orgs
+        self.graphql = graphql
+
+    def endpoints(self):
+        endpoints = super(GitHubService, self).endpoints()
+        if self.graphql:
+            endpoints.append(self.graphql_endpoint)
+        else:
+            endpoints.append('https://api.github.com/user')
+        return endpoints
+
+    def load_viewer(self, access_token):
+        """Load the login, the name, and the membership of
+        :attr:`allowed_orgs` of the authenticated user in a single GraphQL
+        query.  The result is remembered by the ``access_token`` object,
+        so that :meth:`load_username()` and :meth:`is_user_allowed()` share
+        the query.
+
+        :param access_token: a valid :class:`AccessToken`
+        :returns: a :class:`dict` that has ``'login'``, ``'name'`` and
+                  ``'organizations'`` (the allowed organizations the user
+                  is a member of), or :const:`None` if the GraphQL API
+                  rejects the query
+        :rtype: :class:`dict`
+
+        .. versionadded:: 0.2.3
+
+        """
+        viewer = access_token._claims
+        if viewer is not None:
+            return viewer
+        orgs = list(self.allowed_orgs or ())
+        variables = dict(('o{0}'.format(i), org) for i, org in enumerate(orgs))
+        # e.g. query($o0:String!){viewer{login name}
+        #      o0:organization(login:$o0){viewerIsAMember}}
+        params = ','.join('$o{0}:String!'.format(i) for i in range(len(orgs)))
+        fields = ''.join(
+            'o{0}:organization(login:$o{0}){{viewerIsAMember}}'.format(i)
+            for i in range(len(orgs))
+        )
+        query = 'query{0}{{viewer{{login name}}{1}}}'.format(
+            '({0})'.format(params) if orgs else '', fields
+        )
+        body = json.dumps({'query': query, 'variables': variables})
+        request = urllib2.Request(self.graphql_endpoint,
+                                  data=body.encode('utf-8'))
+        request.add_header('Content-Type', 'application/json')
+        request.add_header('Authorization',
+                           'bearer ' + access_token.access_token)
+        try:
+            response = access_token._urlopen(request)
+        except urllib2.HTTPError as e:
+            if _is_transient(e):
+                raise
+            return None
+        try:
+            data = json.loads(response.read().decode('utf-8')).get('data')
+        except ValueError:
+            return None
+        finally:
+            response.close()
+        # Organizations that don't exist or are invisible to the user are
+        # reported as errors, and have null in the data
+        if not (data and data.get('viewer')):
+            return None
+        viewer = {
+            'login': data['viewer']['login'],
+            'name': data['viewer'].get('name') or '',
+            'organizations': [
+                org for i, org in enumerate(orgs)
+                if (data.get('o{0}'.format(i)) or {}).get('viewerIsAMember')
+            ]
+        }
+        access_token._claims = viewer
+        return viewer
 
     def load_username(self, access_token):
         """Load a username from the service suitable for the REMOTE_USER
@@ -188,6 +759,12 @@ class GitHubService(Service):
         .. versionadded:: 0.1.2
 
         """
+        if self.graphql:
+            viewer = self.load_viewer(access_token)
+            if viewer is not None:
+                access_token["username"] = viewer["login"]
+                access_token["name"] = viewer["name"]
+                return
         response = access_token.get('https://api.github.com/user')
         response = response.read()
         response = json.loads(response)
@@ -212,6 +789,11 @@ class GitHubService(Service):
         if not self.allowed_orgs:
             return True
 
+        if self.graphql:
+            viewer = self.load_viewer(access_token)
+            if viewer is not None:
+                return bool(viewer['organizations'])
+
         # Get a list of organizations for the authenticated user
         response = access_token.get("https://api.github.com/user/orgs")
         response = response.read()
@@ -226,180 +808,2390 @@ class GitHubService(Service):
 GithubService = GitHubService
 
 
-class Client(object):
-    """Client for :class:`Service`.
+class IDTokenError(ValueError):
+    """Raised when an OpenID Connect ``id_token`` is missing, malformed,
+    expired, or its signature cannot be verified.
 
-    :param service: service the client connects to
-    :type servie: :class:`Service`
-    :param client_id: client id
-    :type client_id: :class:`basestring`, :class:`numbers.Integral`
-    :param client_secret: client secret key
-    :type client_secret: :class:basestring`
-    :param \*\*extra: additional arguments for authorization e.g.
-                      ``scope='email,read_stream'``
+    .. versionadded:: 0.2.3
 
     """
 
-    #: (:class:`Service`) The service the client connects to.
-    service = None
 
-    #: (:class:`basestring`) The client id.
-    client_id = None
+def _b64url_decode(value):
+    if not isinstance(value, bytes):
+        value = value.encode('ascii')
+    return base64.urlsafe_b64decode(value + b'=' * (-len(value) % 4))
 
-    #: (:class:`basestring`) The client secret key.
-    client_secret = None
 
-    #: (:class:`dict`) The additional arguments for authorization e.g.
-    #: ``{'scope': 'email,read_stream'}``.
+def _bytes_to_int(value):
+    return int(binascii.hexlify(value), 16) if value else 0
 
-    def __init__(self, service, client_id, client_secret, **extra):
-        if not isinstance(service, Service):
-            raise TypeError('service must be a wsgioauth2.Service instance, '
-                            'not ' + repr(service))
-        elif isinstance(client_id, numbers.Integral):
-            client_id = str(client_id)
-        elif not isinstance(client_id, basestring):
-            raise TypeError('client_id must be a string, not ' +
-                            repr(client_id))
-        elif not isinstance(client_secret, basestring):
-            raise TypeError('client_secret must be a string, not ' +
-                            repr(client_secret))
-        self.service = service
-        self.client_id = client_id
-        self.client_secret = client_secret
-        self.extra = extra
 
-    def make_authorize_url(self, redirect_uri, state=None):
-        """Makes an authorize URL.
+def _int_to_bytes(value, length):
+    return binascii.unhexlify('{0:0{1}x}'.format(value, length * 2))
 
-        :param redirect_uri: callback url
-        :type redirect_uri: :class:`basestring`
-        :param state: optional state to get when the user returns to
-                      callback
-        :type state: :class:`basestring`
-        :returns: generated authorize url
-        :rtype: :class:`basestring`
+
+# The DER-encoded DigestInfo prefixes of EMSA-PKCS1-v1_5 (RFC 8017)
+_RSA_ALGORITHMS = {
+    'RS256': (hashlib.sha256,
+              binascii.unhexlify('3031300d060960864801650304020105000420')),
+    'RS384': (hashlib.sha384,
+              binascii.unhexlify('3041300d060960864801650304020205000430')),
+    'RS512': (hashlib.sha512,
+              binascii.unhexlify('3051300d060960864801650304020305000440')),
+}
+
+
+def _rsa_verify(key, algorithm, message, signature):
+    """Verifies an RSASSA-PKCS1-v1_5 ``signature`` of the ``message`` with
+    the public ``key``, a pair of the modulus and the exponent.
+
+    """
+    hash_function, prefix = _RSA_ALGORITHMS[algorithm]
+    n, e = key
+    length = (n.bit_length() + 7) // 8
+    if len(signature) != length:
+        return False
+    s = _bytes_to_int(signature)
+    if s >= n:
+        return False
+    digest_info = prefix + hash_function(message).digest()
+    padding = length - len(digest_info) - 3
+    if padding < 8:
+        return False
+    expected = b'\x00\x01' + b'\xff' * padding + b'\x00' + digest_info
+    return _compare_digest(_int_to_bytes(pow(s, e, n), length), expected)
+
+
+class OpenIDConnectService(Service):
+    """OAuth 2.0 service provider that supports `OpenID Connect`__.  The user
+    is identified by the ``id_token`` that comes with the access token,
+    and it is verified locally against the provider's JSON Web Key Set,
+    so that no extra HTTP call is needed to load the username.  Only RSA
+    signatures (``RS256``, ``RS384`` and ``RS512``) are supported.
+
+    The key set is kept in memory, and also on disk if ``jwks_cache_path``
+    is given so that other processes and restarts don't have to download
+    it.  It is downloaded again only when an ``id_token`` is signed with
+    an unknown key.
+
+    The ``openid`` scope has to be requested, e.g.,
+    ``service.make_client(..., scope='openid email')``.
+
+    :param authorize_endpoint: api url for authorization
+    :type authorize_endpoint: :class:`basestring`
+    :param access_token_endpoint: api url for getting access token
+    :type access_token_endpoint: :class:`basestring`
+    :param issuer: the issuer identifier, which has to match the ``iss``
+                   claim.  several identifiers can be given as a sequence
+    :type issuer: :class:`basestring`,
+                  :class:`collections.Sequence` of :class:`basestring`
+    :param jwks_uri: url of the JSON Web Key Set document
+    :type jwks_uri: :class:`basestring`
+    :param username_claim: the claim used as the username.
+                           default is ``'sub'``
+    :type username_claim: :class:`basestring`
+    :param allowed_claims: the claims users must have to access the
+                           protected application, e.g.,
+                           ``{'hd': 'example.com'}``.  each value is
+                           a string or a container of allowed values
+    :type allowed_claims: :class:`collections.Mapping`
+    :param jwks_cache_path: an optional file path to cache the key set
+    :type jwks_cache_path: :class:`basestring`
+    :param leeway: seconds of allowed clock skew for the ``exp`` and
+                   ``nbf`` claims.  default is 60
+    :type leeway: :class:`numbers.Real`
+    :param introspection_endpoint: optional api url for token
+                                   introspection
+    :type introspection_endpoint: :class:`basestring`
+    :param userinfo_endpoint: optional api url that returns the user's
+                              claims for a bearer token
+    :type userinfo_endpoint: :class:`basestring`
+
+    __ https://openid.net/connect/
+
+    .. versionadded:: 0.2.3
+
+    """
+
+    #: (:class:`basestring`) The issuer identifier.
+    issuer = None
+
+    #: (:class:`frozenset`) All accepted issuer identifiers.
+    issuers = None
+
+    #: (:class:`basestring`) The url of the JSON Web Key Set document.
+    jwks_uri = None
+
+    #: (:class:`basestring`) The claim used as the username.
+    username_claim = None
+
+    #: (:class:`collections.Mapping`) The claims users must have.
+    allowed_claims = None
+
+    #: (:class:`basestring`) The file path to cache the key set.
+    jwks_cache_path = None
+
+    #: (:class:`numbers.Real`) Seconds of allowed clock skew.
+    leeway = None
+
+    #: (:class:`numbers.Real`) The minimum seconds between downloads of
+    #: the key set, so that tokens with bogus key ids cannot make it
+    #: download the key set on every request.
+    jwks_refresh_interval = 60
+
+    def __init__(self, authorize_endpoint, access_token_endpoint,
+                 issuer, jwks_uri, username_claim='sub', allowed_claims=None,
+                 jwks_cache_path=None, leeway=60,
+                 introspection_endpoint=None, userinfo_endpoint=None):
+        super(OpenIDConnectService, self).__init__(
+            authorize_endpoint=authorize_endpoint,
+            access_token_endpoint=access_token_endpoint,
+            introspection_endpoint=introspection_endpoint,
+            userinfo_endpoint=userinfo_endpoint
+        )
+        if isinstance(issuer, basestring):
+            issuer = [issuer]
+        if not issuer:
+            raise ValueError('issuer must not be empty')
+        if not (isinstance(jwks_uri, basestring) and
+                jwks_uri.startswith(('http://', 'https://'))):
+            raise ValueError('jwks_uri must be a url string, not ' +
+                             repr(jwks_uri))
+        if not isinstance(username_claim, basestring):
+            raise TypeError('username_claim must be a string, not ' +
+                            repr(username_claim))
+        claims = {}
+        for claim, values in (allowed_claims or {}).items():
+            # coerce a single value into a list
+            if isinstance(values, basestring) or \
+                    not hasattr(values, '__contains__'):
+                values = [values]
+            claims[claim] = values
+        self.issuer = issuer[0]
+        self.issuers = frozenset(issuer)
+        self.jwks_uri = jwks_uri
+        self.username_claim = username_claim
+        self.allowed_claims = claims
+        self.jwks_cache_path = jwks_cache_path
+        self.leeway = leeway
+        self._jwks_lock = threading.Lock()
+        self._jwks = None
+        self._jwks_fetched_at = None
+
+    @classmethod
+    def from_metadata(cls, metadata, **kwargs):
+        kwargs.setdefault('issuer', metadata['issuer'])
+        kwargs.setdefault('jwks_uri', metadata['jwks_uri'])
+        return super(OpenIDConnectService, cls).from_metadata(metadata,
+                                                              **kwargs)
+
+    def _parse_jwks(self, document):
+        if isinstance(document, bytes):
+            document = document.decode('utf-8')
+        keys = {}
+        for jwk in json.loads(document).get('keys', []):
+            if jwk.get('kty') != 'RSA' or jwk.get('use', 'sig') != 'sig':
+                continue
+            try:
+                key = (_bytes_to_int(_b64url_decode(jwk['n'])),
+                       _bytes_to_int(_b64url_decode(jwk['e'])))
+            except (KeyError, TypeError, ValueError, binascii.Error):
+                continue
+            keys[jwk.get('kid')] = key
+        return keys
+
+    def _fetch_jwks(self, client):
+        if client is None:
+            response = urllib2.urlopen(self.jwks_uri)
+        else:
+            response = client.urlopen(self.jwks_uri)
+        try:
+            document = response.read()
+        finally:
+            response.close()
+        keys = self._parse_jwks(document)
+        if self.jwks_cache_path is not None:
+            try:
+                _write_file_atomically(self.jwks_cache_path, document)
+            except EnvironmentError:
+                # The disk cache is only an optimization
+                pass
+        return keys
+
+    def _read_jwks_cache(self):
+        try:
+            with open(self.jwks_cache_path, 'rb') as f:
+                return self._parse_jwks(f.read())
+        except (EnvironmentError, ValueError):
+            return None
+
+    @property
+    def can_validate_tokens(self):
+        # Bearer tokens come without an id_token, so that load_username()
+        # cannot validate them
+        return (self.introspection_endpoint is not None or
+                self.userinfo_endpoint is not None or
+                self._overrides('validate_token'))
+
+    def endpoints(self):
+        endpoints = super(OpenIDConnectService, self).endpoints()
+        endpoints.append(self.jwks_uri)
+        return endpoints
+
+    def warmup(self, client=None):
+        """Loads the key set from the disk cache, or the provider if it is
+        not cached yet.
+
+        :param client: an optional client to download the key set through
+        :type client: :class:`Client`
+        :returns: ``{'jwks': <the number of keys>}``
+        :rtype: :class:`dict`
+
+        .. versionadded:: 0.2.3
 
         """
-        query = dict(self.extra)
-        query.update(client_id=self.client_id,
-                     redirect_uri=redirect_uri,
-                     response_type='code')
-        if state is not None:
-            query['state'] = state
-        return '{0}?{1}'.format(self.service.authorize_endpoint,
-                                urlencode(query))
+        with self._jwks_lock:
+            if self._jwks is None and self.jwks_cache_path is not None:
+                self._jwks = self._read_jwks_cache()
+            if self._jwks is None:
+                self._jwks_fetched_at = _clock()
+                self._jwks = self._fetch_jwks(client)
+            return {'jwks': len(self._jwks)}
+
+    def get_signing_key(self, key_id, client=None):
+        """Finds the public key of the ``key_id`` from the key set.  The key
+        set is loaded from memory, the disk cache, or the provider in order,
+        and is downloaded again only if the ``key_id`` is unknown.
+
+        :param key_id: the ``kid`` of the ``id_token`` header
+        :type key_id: :class:`basestring`
+        :param client: an optional client to download the key set through
+        :type client: :class:`Client`
+        :returns: a pair of the modulus and the exponent, or :const:`None`
+                  if there is no such key
+        :rtype: :class:`tuple`
+
+        """
+        jwks = self._jwks
+        if jwks is not None and key_id in jwks:
+            return jwks[key_id]
+        with self._jwks_lock:
+            if self._jwks is None and self.jwks_cache_path is not None:
+                self._jwks = self._read_jwks_cache()
+            if self._jwks is None or key_id not in self._jwks:
+                fetched_at = self._jwks_fetched_at
+                now = _clock()
+                if fetched_at is None or \
+                        now - fetched_at >= self.jwks_refresh_interval:
+                    self._jwks_fetched_at = now
+                    self._jwks = self._fetch_jwks(client)
+            return (self._jwks or {}).get(key_id)
+
+    def verify_id_token(self, access_token):
+        """Verifies the ``id_token`` of the ``access_token`` and returns its
+        claims.  The result is remembered by the ``access_token`` object,
+        so that :meth:`load_username()` and :meth:`is_user_allowed()` verify
+        it only once.
+
+        :param access_token: a valid :class:`AccessToken`.  its
+                             :attr:`~AccessToken.client` has to be set
+                             to check the audience of the ``id_token``
+        :returns: the claims of the ``id_token``
+        :rtype: :class:`dict`
+        :raises IDTokenError: when the ``id_token`` is missing or invalid,
+                              or the ``access_token`` has no client
+
+        """
+        claims = getattr(access_token, '_claims', None)
+        if claims is not None:
+            return claims
+        # AccessToken.get() is for HTTP requests, not dict.get()
+        id_token = dict.get(access_token, 'id_token')
+        if isinstance(id_token, list):
+            id_token = id_token[0] if id_token else None
+        if not id_token:
+            raise IDTokenError('the response has no id_token; the openid '
+                               'scope may not be requested')
+        if not isinstance(id_token, bytes):
+            id_token = id_token.encode('ascii')
+        try:
+            signing_input, signature = id_token.rsplit(b'.', 1)
+            header, payload = signing_input.split(b'.')
+            header = json.loads(_b64url_decode(header).decode('utf-8'))
+            claims = json.loads(_b64url_decode(payload).decode('utf-8'))
+            signature = _b64url_decode(signature)
+        except (TypeError, ValueError, binascii.Error):
+            raise IDTokenError('the id_token is malformed')
+        if not (isinstance(header, dict) and isinstance(claims, dict)):
+            raise IDTokenError('the id_token is malformed')
+        algorithm = header.get('alg')
+        if algorithm not in _RSA_ALGORITHMS:
+            raise IDTokenError('unsupported id_token algorithm: ' +
+                               repr(algorithm))
+        client = access_token.client
+        if client is None:
+            raise IDTokenError('the audience of the id_token cannot be '
+                               'checked without AccessToken.client')
+        key = self.get_signing_key(header.get('kid'), client)
+        if key is None:
+            raise IDTokenError('unknown id_token key: ' +
+                               repr(header.get('kid')))
+        if not _rsa_verify(key, algorithm, signing_input, signature):
+            raise IDTokenError('the id_token signature is invalid')
+        if claims.get('iss') not in self.issuers:
+            raise IDTokenError('unexpected id_token issuer: ' +
+                               repr(claims.get('iss')))
+        audience = claims.get('aud')
+        if isinstance(audience, basestring):
+            audience = [audience]
+        if client.client_id not in (audience or ()) or \
+                claims.get('azp', client.client_id) != client.client_id:
+            raise IDTokenError('the id_token is not issued for ' +
+                               repr(client.client_id))
+        now = time.time()
+        try:
+            expires_at = float(claims['exp'])
+            not_before = float(claims.get('nbf', 0))
+        except (KeyError, TypeError, ValueError):
+            raise IDTokenError('the id_token has no valid exp claim')
+        if expires_at + self.leeway < now:
+            raise IDTokenError('the id_token has expired')
+        elif not_before - self.leeway > now:
+            raise IDTokenError('the id_token is not valid yet')
+        access_token._claims = claims
+        return claims
 
     def load_username(self, access_token):
-        """Load a username from the configured service suitable for the
-        REMOTE_USER variable. A valid :class:`AccessToken` is provided to allow
-        access to authenticated resources provided by the service. For GitHub
-        the 'login' variable is used.
+        """Load a username from the ``id_token`` suitable for the REMOTE_USER
+        variable.  The :attr:`username_claim` is used, and the ``name``
+        claim is copied as well if present.
+
+        :param access_token: a valid :class:`AccessToken`
+        :raises IDTokenError: when the ``id_token`` is missing or invalid
+
+        """
+        claims = self.verify_id_token(access_token)
+        try:
+            access_token['username'] = claims[self.username_claim]
+        except KeyError:
+            raise IDTokenError('the id_token has no {0} claim'.format(
+                self.username_claim
+            ))
+        if 'name' in claims:
+            access_token['name'] = claims['name']
+
+    def is_user_allowed(self, access_token):
+        """Check if the user has all the :attr:`allowed_claims`.
+        A claim that is a list is allowed if any of its values is allowed.
+        If no :attr:`allowed_claims` were specified, all authenticated users
+        will be allowed.
+
+        :param access_token: a valid :class:`AccessToken`
+        :raises IDTokenError: when the ``id_token`` is missing or invalid
+
+        """
+        if not self.allowed_claims:
+            return True
+        # Bearer tokens have the claims from the userinfo or introspection
+        # response instead of the id_token
+        claims = getattr(access_token, '_claims', None)
+        if claims is None:
+            claims = self.verify_id_token(access_token)
+        for claim, allowed_values in self.allowed_claims.items():
+            if claim not in claims:
+                return False
+            values = claims[claim]
+            if not isinstance(values, list):
+                values = [values]
+            if not any(value in allowed_values for value in values):
+                return False
+        return True
+
+
+class GoogleService(OpenIDConnectService):
+    """OpenID Connect service provider for Google.  The username is
+    the ``email`` claim, so the ``openid email`` scope has to be requested
+    to set ``REMOTE_USER``.
+
+    Bearer tokens are checked through the :attr:`tokeninfo_endpoint`,
+    which tells the client a token is issued to, and then their claims
+    are loaded from the :attr:`userinfo_endpoint`.
+
+    :param allowed_claims: the claims users must have to access the
+                           protected application, e.g.,
+                           ``{'hd': 'example.com'}``
+    :type allowed_claims: :class:`collections.Mapping`
+    :param jwks_cache_path: an optional file path to cache the key set
+    :type jwks_cache_path: :class:`basestring`
+
+    .. versionadded:: 0.2.3
+
+    """
+
+    #: (:class:`basestring`) The endpoint that tells the client, the user
+    #: and the expiry of an access token.
+    tokeninfo_endpoint = 'https://oauth2.googleapis.com/tokeninfo'
+
+    def __init__(self, allowed_claims=None, jwks_cache_path=None):
+        super(GoogleService, self).__init__(
+            authorize_endpoint='https://accounts.google.com/o/oauth2/auth',
+            access_token_endpoint='https://accounts.google.com/o/oauth2/token',
+            issuer=['https://accounts.google.com', 'accounts.google.com'],
+            jwks_uri='https://www.googleapis.com/oauth2/v3/certs',
+            username_claim='email',
+            allowed_claims=allowed_claims,
+            jwks_cache_path=jwks_cache_path,
+            userinfo_endpoint='https://openidconnect.googleapis.com/v1/'
+                              'userinfo'
+        )
+
+    def endpoints(self):
+        endpoints = super(GoogleService, self).endpoints()
+        endpoints.append(self.tokeninfo_endpoint)
+        return endpoints
+
+    def validate_token(self, access_token):
+        # Userinfo responses have no aud, so that tokens issued to any
+        # other Google client would be accepted without tokeninfo
+        url = '{0}?{1}'.format(
+            self.tokeninfo_endpoint,
+            urlencode({'access_token': access_token.access_token})
+        )
+        try:
+            response = access_token._urlopen(url)
+        except urllib2.HTTPError as e:
+            if _is_transient(e):
+                raise
+            return False
+        try:
+            claims = json.loads(response.read().decode('utf-8'))
+        finally:
+            response.close()
+        if not (isinstance(claims, dict) and 'aud' in claims and
+                _is_token_for(claims, access_token.client)):
+            return False
+        return super(GoogleService, self).validate_token(access_token)
+
+
+class CircuitOpenError(IOError):
+    """Raised instead of requesting an endpoint while its circuit is open,
+    i.e., while the :class:`CircuitBreaker` considers the provider unhealthy.
+
+    .. versionadded:: 0.2.3
+
+    """
+
+    #: (:class:`basestring`) The endpoint url without query string.
+    endpoint = None
+
+    #: (:class:`numbers.Real`) Seconds until the endpoint is tried again.
+    retry_after = None
+
+    def __init__(self, endpoint, retry_after):
+        super(CircuitOpenError, self).__init__(
+            'circuit for {0} is open; retry after {1:.1f} seconds'.format(
+                endpoint, retry_after
+            )
+        )
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+    """Per-endpoint circuit breaker for provider HTTP calls.  After
+    ``failure_threshold`` consecutive transient failures (connection errors,
+    timeouts, ``5xx`` and ``429`` responses) of an endpoint, its circuit
+    opens and further calls fail fast with :exc:`CircuitOpenError` for
+    ``recovery_timeout`` seconds.  Then a single probe request is let
+    through: if it succeeds the circuit closes, otherwise it opens again.
+
+    A breaker is thread-safe and can be shared by several :class:`Client`
+    objects.
+
+    :param failure_threshold: the number of consecutive failures that opens
+                              the circuit.  default is 5
+    :type failure_threshold: :class:`numbers.Integral`
+    :param recovery_timeout: seconds to fail fast before probing the
+                             endpoint again.  default is 30
+    :type recovery_timeout: :class:`numbers.Real`
+
+    .. versionadded:: 0.2.3
+
+    """
+
+    #: (:class:`numbers.Integral`) The number of consecutive failures that
+    #: opens the circuit.
+    failure_threshold = None
+
+    #: (:class:`numbers.Real`) Seconds to fail fast before probing again.
+    recovery_timeout = None
+
+    def __init__(self, failure_threshold=5, recovery_timeout=30.0):
+        if not isinstance(failure_threshold, numbers.Integral):
+            raise TypeError('failure_threshold must be an integer, not ' +
+                            repr(failure_threshold))
+        elif failure_threshold < 1:
+            raise ValueError('failure_threshold must be greater than 0, not ' +
+                             repr(failure_threshold))
+        elif not isinstance(recovery_timeout, numbers.Real):
+            raise TypeError('recovery_timeout must be a number, not ' +
+                            repr(recovery_timeout))
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._lock = threading.Lock()
+        self._failures = {}
+        self._opened_at = {}
+
+    def before_call(self, endpoint):
+        """Checks the circuit of the ``endpoint`` before calling it.
+
+        :param endpoint: the endpoint url without query string
+        :type endpoint: :class:`basestring`
+        :raises CircuitOpenError: when the circuit is open
+
+        """
+        with self._lock:
+            opened_at = self._opened_at.get(endpoint)
+            if opened_at is None:
+                return
+            now = _clock()
+            elapsed = now - opened_at
+            if elapsed < self.recovery_timeout:
+                raise CircuitOpenError(endpoint,
+                                       self.recovery_timeout - elapsed)
+            # Half-open: this caller becomes the probe, and the others keep
+            # failing fast until the probe reports its result.
+            self._opened_at[endpoint] = now
+
+    def record_success(self, endpoint):
+        """Closes the circuit of the ``endpoint``."""
+        with self._lock:
+            self._failures.pop(endpoint, None)
+            self._opened_at.pop(endpoint, None)
+
+    def record_failure(self, endpoint):
+        """Counts a transient failure of the ``endpoint``, and opens its
+        circuit if it reaches :attr:`failure_threshold`.
+
+        """
+        with self._lock:
+            failures = self._failures.get(endpoint, 0) + 1
+            self._failures[endpoint] = failures
+            if failures >= self.failure_threshold:
+                self._opened_at[endpoint] = _clock()
+
+    def is_open(self, endpoint):
+        """Whether the circuit of the ``endpoint`` is currently open.
+
+        :rtype: :class:`bool`
+
+        """
+        with self._lock:
+            opened_at = self._opened_at.get(endpoint)
+        return (opened_at is not None and
+                _clock() - opened_at < self.recovery_timeout)
+
+
+def _endpoint(url):
+    """Strips the query string and the fragment from the ``url``."""
+    url = urlparse.urlsplit(url)
+    return '{0}://{1}{2}'.format(url.scheme, url.netloc, url.path)
+
+
+class RateLimitTracker(object):
+    """Tracks the API rate limit budgets of a provider from
+    the ``X-RateLimit-Limit``, ``X-RateLimit-Remaining`` and
+    ``X-RateLimit-Reset`` response headers, e.g., of GitHub.  Budgets are
+    kept per ``X-RateLimit-Resource`` if the provider tells it (GitHub
+    has separate budgets for REST and GraphQL APIs), or per host.
+
+    It is thread-safe.  Every :class:`Client` has its own tracker as
+    :attr:`Client.rate_limits`.
+
+    :param reserve: the fraction of the limit below which the budget is
+                    considered low.  default is 0.1
+    :type reserve: :class:`numbers.Real`
+
+    .. versionadded:: 0.2.3
+
+    """
+
+    #: (:class:`numbers.Real`) The fraction of the limit below which
+    #: the budget is considered low.
+    reserve = None
+
+    def __init__(self, reserve=0.1):
+        if not isinstance(reserve, numbers.Real):
+            raise TypeError('reserve must be a number, not ' + repr(reserve))
+        self.reserve = reserve
+        self._lock = threading.Lock()
+        self._resources = {}
+        self._budgets = {}
+
+    def update(self, url, headers):
+        """Reads the rate limit ``headers`` of a response from the ``url``.
+
+        :param url: the requested url
+        :type url: :class:`basestring`
+        :param headers: the response headers
+
+        """
+        try:
+            limit = int(headers.get('X-RateLimit-Limit'))
+            remaining = int(headers.get('X-RateLimit-Remaining'))
+            reset = int(headers.get('X-RateLimit-Reset'))
+        except (TypeError, ValueError):
+            return
+        endpoint = _endpoint(url)
+        resource = headers.get('X-RateLimit-Resource') or \
+            urlparse.urlsplit(url).netloc
+        with self._lock:
+            self._resources[endpoint] = resource
+            self._budgets[resource] = limit, remaining, reset
+
+    def budget(self, url):
+        """Gets the last known budget for the ``url``.
+
+        :param url: the url to request
+        :type url: :class:`basestring`
+        :returns: a :class:`dict` that has ``'limit'``, ``'remaining'`` and
+                  ``'reset'`` (the time when the budget is reset, in seconds
+                  since the epoch), or :const:`None` if it is unknown
+        :rtype: :class:`dict`
+
+        """
+        with self._lock:
+            resource = self._resources.get(_endpoint(url))
+            budget = self._budgets.get(resource)
+        if budget is None:
+            return None
+        limit, remaining, reset = budget
+        if reset <= time.time():
+            remaining = limit
+        return {'limit': limit, 'remaining': remaining, 'reset': reset}
+
+    def is_low(self, url):
+        """Whether the remaining budget for the ``url`` is under
+        the :attr:`reserve`, so that optional requests should be avoided
+        and cached data should be used instead if possible.
+
+        :param url: the url to request
+        :type url: :class:`basestring`
+        :rtype: :class:`bool`
+
+        """
+        budget = self.budget(url)
+        return (budget is not None and
+                budget['remaining'] <= budget['limit'] * self.reserve)
+
+
+class ResponseCache(object):
+    """Thread-safe in-memory cache of provider API responses for
+    :meth:`AccessToken.get()`.  Responses are stored with their ``ETag``
+    and ``Last-Modified`` validators, so that later requests are made
+    conditionally and an unchanged resource costs only a ``304 Not
+    Modified`` response, which does not count against GitHub's rate
+    limit.  Responses without validators are not cached.
+
+    :param max_size: the maximum number of responses.  the least recently
+                     used responses are evicted first.  default is 1000
+    :type max_size: :class:`numbers.Integral`
+
+    .. versionadded:: 0.2.3
+
+    """
+
+    #: (:class:`numbers.Integral`) The maximum number of responses.
+    max_size = None
+
+    def __init__(self, max_size=1000):
+        if not isinstance(max_size, numbers.Integral):
+            raise TypeError('max_size must be an integer, not ' +
+                            repr(max_size))
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    @staticmethod
+    def key(url):
+        """Makes the cache key of the ``url``, which contains the access
+        token, so that the cache holds no token in plain text.
+
+        :rtype: :class:`bytes`
+
+        """
+        if not isinstance(url, bytes):
+            url = url.encode('utf-8')
+        return hashlib.sha256(url).digest()
+
+    def get(self, key):
+        """Gets the cached response of the ``key``: a tuple of the body,
+        the headers, the ``ETag``, and the ``Last-Modified``.  Returns
+        :const:`None` if it is not cached.
+
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+
+    def set(self, key, body, headers):
+        """Caches the response ``body`` and ``headers`` of the ``key`` if it
+        has validators.
+
+        """
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if not (etag or last_modified):
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = body, headers, etag, last_modified
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _is_transient(error):
+    """Whether the provider ``error`` is worth retrying, i.e., it is not
+    a definite ``4xx`` answer from a healthy provider.
+
+    """
+    if isinstance(error, urllib2.HTTPError):
+        return error.code >= 500 or error.code == 429
+    return True
+
+
+def _mark_connect_error(error):
+    # Nothing has been sent when connecting fails, so that even
+    # a non-idempotent request is safe to retry
+    error.wsgioauth2_connect_error = True
+
+
+def _is_connect_error(error):
+    """Whether the request failed by the ``error`` before it was sent."""
+    return getattr(error, 'wsgioauth2_connect_error', False) or \
+        getattr(getattr(error, 'reason', None), 'wsgioauth2_connect_error',
+                False)
+
+
+class _RetryBudget(object):
+    """Token bucket that limits retries to a fraction of requests, so that
+    retries don't multiply the load on a provider in an outage.  Every
+    request deposits ``ratio`` tokens, and every retry withdraws one.
+
+    """
+
+    def __init__(self, ratio, capacity):
+        self.ratio = ratio
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+def _is_idle_connection_alive(sock):
+    """Whether the idle ``sock`` is still open, i.e., the peer has neither
+    closed it nor sent anything unexpected.
+
+    """
+    timeout = sock.gettimeout()
+    sock.settimeout(0.0)
+    try:
+        sock.recv(1)
+    except socket.error as e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return True
+        # TLS records without application data, e.g., session tickets
+        import ssl
+        return isinstance(e, ssl.SSLError) and \
+            e.errno == ssl.SSL_ERROR_WANT_READ
+    finally:
+        sock.settimeout(timeout)
+    # Closed, or unexpected data
+    return False
+
+
+def _make_ssl_context():
+    """Makes the TLS context shared by the connections of a client, so that
+    CA certificates are loaded once instead of for every connection.
+
+    """
+    try:
+        import ssl
+    except ImportError:
+        return None
+    # The same factory httplib uses when no context is given
+    create_context = getattr(ssl, '_create_default_https_context', None)
+    if create_context is None:
+        return None
+    context = create_context()
+    if getattr(ssl, 'HAS_ALPN', False):
+        context.set_alpn_protocols(['http/1.1'])
+    return context
+
+
+class _ConnectionPool(object):
+    """Connections opened ahead by :meth:`Client.warmup()`.  Each of them
+    is taken once for a request, unless it has been idle too long or
+    the peer has closed it.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections = {}
+
+    def put(self, key, connection, ttl):
+        with self._lock:
+            self._connections.setdefault(key, []).append(
+                (_clock() + ttl, connection)
+            )
+
+    def take(self, key):
+        if not self._connections:
+            return None
+        while True:
+            with self._lock:
+                connections = self._connections.get(key)
+                if not connections:
+                    return None
+                expires_at, connection = connections.pop()
+                if not connections:
+                    del self._connections[key]
+            if expires_at > _clock() and \
+                    _is_idle_connection_alive(connection.sock):
+                return connection
+            connection.close()
+
+    def __len__(self):
+        return sum(len(c) for c in self._connections.values())
+
+
+def _define_handlers():
+    """Defines the handlers of :attr:`Client.opener`.  They subclass
+    :mod:`httplib` and :mod:`urllib2` classes, so they are defined on first
+    use for these modules to be imported lazily.
+
+    """
+    class _HTTPConnection(httplib.HTTPConnection):
+        """HTTP connection which switches to the read timeout once
+        connected.
+
+        """
+
+        read_timeout = None
+
+        def connect(self):
+            try:
+                httplib.HTTPConnection.connect(self)
+            except EnvironmentError as e:
+                _mark_connect_error(e)
+                raise
+            if self.read_timeout is not None:
+                self.sock.settimeout(self.read_timeout)
+
+    class _HTTPHandler(urllib2.HTTPHandler):
+
+        def __init__(self, read_timeout=None, pool=None):
+            urllib2.HTTPHandler.__init__(self)
+            self.read_timeout = read_timeout
+            self.pool = pool
+
+        def _new_connection(self, host, **kwargs):
+            connection = _HTTPConnection(host, **kwargs)
+            connection.read_timeout = self.read_timeout
+            return connection
+
+        def _make_connection(self, host, **kwargs):
+            if self.pool is not None:
+                connection = self.pool.take(('http', host))
+                if connection is not None:
+                    return connection
+            return self._new_connection(host, **kwargs)
+
+        def http_open(self, req):
+            return self.do_open(self._make_connection, req)
+
+    if hasattr(httplib, 'HTTPSConnection'):
+        class _HTTPSConnection(httplib.HTTPSConnection):
+            """HTTPS connection which switches to the read timeout once the TLS
+            handshake is done.
+
+            """
+
+            read_timeout = None
+
+            def connect(self):
+                try:
+                    httplib.HTTPSConnection.connect(self)
+                except EnvironmentError as e:
+                    _mark_connect_error(e)
+                    raise
+                if self.read_timeout is not None:
+                    self.sock.settimeout(self.read_timeout)
+
+        class _HTTPSHandler(urllib2.HTTPSHandler):
+
+            def __init__(self, read_timeout=None, context=None, pool=None):
+                urllib2.HTTPSHandler.__init__(self, context=context)
+                self.read_timeout = read_timeout
+                self.pool = pool
+
+            def _new_connection(self, host, **kwargs):
+                kwargs.setdefault('context', self._context)
+                connection = _HTTPSConnection(host, **kwargs)
+                connection.read_timeout = self.read_timeout
+                return connection
+
+            def _make_connection(self, host, **kwargs):
+                if self.pool is not None:
+                    connection = self.pool.take(('https', host))
+                    if connection is not None:
+                        return connection
+                return self._new_connection(host, **kwargs)
+
+            def https_open(self, req):
+                return self.do_open(self._make_connection, req,
+                                    context=self._context)
+    else:
+        _HTTPSHandler = None
+    return _HTTPHandler, _HTTPSHandler
+
+
+_handlers = None
+
+
+def _make_handlers(read_timeout, pool):
+    global _handlers
+    if _handlers is None:
+        _handlers = _define_handlers()
+    http_handler, https_handler = _handlers
+    handlers = {'http': http_handler(read_timeout, pool)}
+    if https_handler is not None:
+        handlers['https'] = https_handler(read_timeout, _make_ssl_context(),
+                                          pool)
+    return handlers
+
+
+class Client(object):
+    """Client for :class:`Service`.
+
+    :param service: service the client connects to
+    :type servie: :class:`Service`
+    :param client_id: client id
+    :type client_id: :class:`basestring`, :class:`numbers.Integral`
+    :param client_secret: client secret key
+    :type client_secret: :class:basestring`
+    :param timeout: seconds to wait for the provider.  a pair of numbers
+                    sets the connect timeout and the read timeout
+                    separately.  by default, the global socket timeout
+                    is used
+    :type timeout: :class:`numbers.Real`, :class:`tuple`
+    :param retries: how many times a request failed by a transient error
+                    (connection errors, timeouts, ``5xx`` and ``429``
+                    responses) is retried, with jittered exponential
+                    backoff.  requests that are not idempotent, e.g.,
+                    the ``POST`` of :meth:`request_access_token()` whose
+                    code can be used only once, are retried only if they
+                    failed to connect.  retries are also limited by
+                    :attr:`retry_budget_ratio`.  default is 0
+    :type retries: :class:`numbers.Integral`
+    :param circuit_breaker: an optional circuit breaker that makes requests
+                            to an unhealthy endpoint fail fast
+    :type circuit_breaker: :class:`CircuitBreaker`
+    :param response_cache: an optional cache that makes
+                           :meth:`AccessToken.get()` send conditional
+                           requests
+    :type response_cache: :class:`ResponseCache`
+    :param \*\*extra: additional arguments for authorization e.g.
+                      ``scope='email,read_stream'``
+
+    .. versionadded:: 0.2.3
+       The ``timeout``, ``retries``, ``circuit_breaker`` and
+       ``response_cache`` options.
+
+    """
+
+    #: (:class:`Service`) The service the client connects to.
+    service = None
+
+    #: (:class:`basestring`) The client id.
+    client_id = None
+
+    #: (:class:`basestring`) The client secret key.
+    client_secret = None
+
+    #: (:class:`dict`) The additional arguments for authorization e.g.
+    #: ``{'scope': 'email,read_stream'}``.
+
+    #: (:class:`numbers.Real`) Seconds to wait for connecting to the provider.
+    #: :const:`None` means the global socket timeout.
+    #:
+    #: .. versionadded:: 0.2.3
+    connect_timeout = None
+
+    #: (:class:`numbers.Real`) Seconds to wait for each read from the
+    #: provider.  :const:`None` means the same as :attr:`connect_timeout`.
+    #:
+    #: .. versionadded:: 0.2.3
+    read_timeout = None
+
+    #: (:class:`numbers.Integral`) How many times a request failed by
+    #: a transient error is retried.
+    #:
+    #: .. versionadded:: 0.2.3
+    retries = 0
+
+    #: (:class:`numbers.Real`) The base delay in seconds of the exponential
+    #: backoff between retries.  Each delay is randomly chosen between zero
+    #: and the exponential delay (so-called full jitter).
+    #:
+    #: .. versionadded:: 0.2.3
+    retry_backoff = 0.1
+
+    #: (:class:`numbers.Real`) The upper bound of a delay between retries.
+    #:
+    #: .. versionadded:: 0.2.3
+    retry_backoff_max = 2.0
+
+    #: (:class:`numbers.Real`) The retries allowed per request on average,
+    #: shared by all requests of the client.  Every request earns this
+    #: fraction of a retry, up to :attr:`retry_budget_max` retries, so that
+    #: in an outage the provider gets only this much more load from retries
+    #: instead of :attr:`retries` times more.
+    #:
+    #: .. versionadded:: 0.2.3
+    retry_budget_ratio = 0.1
+
+    #: (:class:`numbers.Integral`) The maximum number of retries saved up
+    #: by :attr:`retry_budget_ratio`.
+    #:
+    #: .. versionadded:: 0.2.3
+    retry_budget_max = 10
+
+    #: (:class:`CircuitBreaker`) The circuit breaker for provider endpoints.
+    #:
+    #: .. versionadded:: 0.2.3
+    circuit_breaker = None
+
+    #: (:class:`ResponseCache`) The cache of provider API responses.
+    #:
+    #: .. versionadded:: 0.2.3
+    response_cache = None
+
+    #: (:class:`RateLimitTracker`) The rate limit budgets of the provider,
+    #: updated by every response.
+    #:
+    #: .. versionadded:: 0.2.3
+    rate_limits = None
+
+    #: (:class:`numbers.Real`) Seconds to keep the connections opened by
+    #: :meth:`warmup()` for requests.  Providers close idle connections
+    #: sooner or later.
+    #:
+    #: .. versionadded:: 0.2.3
+    warm_connection_ttl = 60.0
+
+    def __init__(self, service, client_id, client_secret,
+                 timeout=None, retries=0, circuit_breaker=None,
+                 response_cache=None, **extra):
+        if not isinstance(service, Service):
+            raise TypeError('service must be a wsgioauth2.Service instance, '
+                            'not ' + repr(service))
+        elif isinstance(client_id, numbers.Integral):
+            client_id = str(client_id)
+        elif not isinstance(client_id, basestring):
+            raise TypeError('client_id must be a string, not ' +
+                            repr(client_id))
+        elif not isinstance(client_secret, basestring):
+            raise TypeError('client_secret must be a string, not ' +
+                            repr(client_secret))
+        if isinstance(timeout, tuple):
+            connect_timeout, read_timeout = timeout
+        else:
+            connect_timeout = read_timeout = timeout
+        for t in connect_timeout, read_timeout:
+            if not (t is None or isinstance(t, numbers.Real)):
+                raise TypeError('timeout must be a number or a pair of '
+                                'numbers, not ' + repr(timeout))
+        if not isinstance(retries, numbers.Integral):
+            raise TypeError('retries must be an integer, not ' +
+                            repr(retries))
+        elif retries < 0:
+            raise ValueError('retries must not be negative, not ' +
+                             repr(retries))
+        if not (circuit_breaker is None or
+                isinstance(circuit_breaker, CircuitBreaker)):
+            raise TypeError('circuit_breaker must be a wsgioauth2.'
+                            'CircuitBreaker instance, not ' +
+                            repr(circuit_breaker))
+        if not (response_cache is None or
+                isinstance(response_cache, ResponseCache)):
+            raise TypeError('response_cache must be a wsgioauth2.'
+                            'ResponseCache instance, not ' +
+                            repr(response_cache))
+        self.service = service
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.circuit_breaker = circuit_breaker
+        self.response_cache = response_cache
+        self.rate_limits = RateLimitTracker()
+        self.extra = extra
+        self._opener = None
+        self._handlers = {}
+        self._warm_connections = _ConnectionPool()
+        self._retry_budget = _RetryBudget(self.retry_budget_ratio,
+                                          self.retry_budget_max)
+
+    @property
+    def opener(self):
+        """(:class:`urllib2.OpenerDirector`) The opener used for requests
+        to the provider.  It applies :attr:`read_timeout` once connected,
+        and shares a TLS context between connections.
+
+        .. versionadded:: 0.2.3
+
+        """
+        if self._opener is None:
+            handlers = _make_handlers(self.read_timeout,
+                                      self._warm_connections)
+            self._handlers = handlers
+            self._opener = urllib2.build_opener(*handlers.values())
+        return self._opener
+
+    def warmup(self, connections=1):
+        """Primes the client before it serves requests, e.g., in a post-fork
+        hook of the server, so that the first requests to the provider are
+        as fast as later ones.  It builds the :attr:`opener` and its TLS
+        context, resolves and opens connections to the hosts of
+        :meth:`Service.endpoints()`, which are taken by the next requests,
+        and calls :meth:`Service.warmup()`.  Errors are reported instead of
+        raised.
+
+        Connections are not opened ahead to hosts reached through a proxy.
+        Unused connections are closed after :attr:`warm_connection_ttl`.
+
+        :param connections: the number of connections to open per host,
+                            e.g., the number of threads of the worker.
+                            default is 1
+        :type connections: :class:`numbers.Integral`
+        :returns: what was primed: ``'endpoints'`` (the urls of
+                  the provider), ``'connections'`` (the number of opened
+                  connections per host), ``'service'`` (what
+                  :meth:`Service.warmup()` loaded), ``'errors'`` (the error
+                  messages per host, or ``'service'``), and ``'elapsed'``
+                  (seconds it took)
+        :rtype: :class:`dict`
+
+        .. versionadded:: 0.2.3
+
+        """
+        started_at = _clock()
+        self.opener
+        endpoints = self.service.endpoints()
+        opened = {}
+        errors = {}
+        timeout = self.connect_timeout
+        if timeout is None:
+            timeout = socket._GLOBAL_DEFAULT_TIMEOUT
+        # Service requests go first so that they don't take the connections
+        try:
+            service = self.service.warmup(self)
+        except (EnvironmentError, httplib.HTTPException, ValueError) as e:
+            service = {}
+            errors['service'] = str(e)
+        proxies = urllib2.getproxies()
+        for url in endpoints:
+            parsed = urlparse.urlparse(url)
+            scheme, host = parsed.scheme, parsed.netloc
+            handler = self._handlers.get(scheme)
+            if handler is None or host in opened or host in errors or \
+                    scheme in proxies and not urllib2.proxy_bypass(host):
+                continue
+            opened[host] = 0
+            try:
+                for _ in range(connections):
+                    connection = handler._new_connection(host,
+                                                         timeout=timeout)
+                    connection.connect()
+                    self._warm_connections.put((scheme, host), connection,
+                                               self.warm_connection_ttl)
+                    opened[host] += 1
+            except (EnvironmentError, httplib.HTTPException) as e:
+                errors[host] = str(e)
+        return {
+            'endpoints': endpoints,
+            'connections': opened,
+            'service': service,
+            'errors': errors,
+            'elapsed': _clock() - started_at
+        }
+
+    def urlopen(self, request):
+        """Opens the ``request`` to the provider with the configured
+        timeouts, retries and circuit breaker.  The rate limit headers of
+        the response are read into :attr:`rate_limits`.
+
+        :param request: url or request object
+        :type request: :class:`basestring`, :class:`urllib2.Request`
+        :returns: file-like response object
+        :raises CircuitOpenError: when the circuit of the endpoint is open
+
+        .. versionadded:: 0.2.3
+
+        """
+        if isinstance(request, basestring):
+            request = urllib2.Request(request)
+        url = request.get_full_url()
+        endpoint = _endpoint(url)
+        timeout = self.connect_timeout
+        if timeout is None:
+            timeout = socket._GLOBAL_DEFAULT_TIMEOUT
+        breaker = self.circuit_breaker
+        idempotent = request.get_method() in ('GET', 'HEAD', 'OPTIONS',
+                                              'PUT', 'DELETE')
+        budget = self._retry_budget
+        budget.deposit()
+        attempt = 0
+        while True:
+            if breaker is not None:
+                breaker.before_call(endpoint)
+            try:
+                response = self.opener.open(request, timeout=timeout)
+            except (EnvironmentError, httplib.HTTPException) as e:
+                if isinstance(e, urllib2.HTTPError):
+                    self.rate_limits.update(url, e.info())
+                transient = _is_transient(e)
+                if breaker is not None:
+                    if transient:
+                        breaker.record_failure(endpoint)
+                    else:
+                        breaker.record_success(endpoint)
+                if not transient or attempt >= self.retries or \
+                        not (idempotent or _is_connect_error(e)) or \
+                        not budget.withdraw():
+                    raise
+                attempt += 1
+                delay = min(self.retry_backoff_max,
+                            self.retry_backoff * 2 ** attempt)
+                time.sleep(random.uniform(0, delay))
+            else:
+                if breaker is not None:
+                    breaker.record_success(endpoint)
+                self.rate_limits.update(url, response.info())
+                return response
+
+    def make_authorize_url(self, redirect_uri, state=None):
+        """Makes an authorize URL.
+
+        :param redirect_uri: callback url
+        :type redirect_uri: :class:`basestring`
+        :param state: optional state to get when the user returns to
+                      callback
+        :type state: :class:`basestring`
+        :returns: generated authorize url
+        :rtype: :class:`basestring`
+
+        """
+        query = dict(self.extra)
+        query.update(client_id=self.client_id,
+                     redirect_uri=redirect_uri,
+                     response_type='code')
+        if state is not None:
+            query['state'] = state
+        return '{0}?{1}'.format(self.service.authorize_endpoint,
+                                urlencode(query))
+
+    def load_username(self, access_token):
+        """Load a username from the configured service suitable for the
+        REMOTE_USER variable. A valid :class:`AccessToken` is provided to allow
+        access to authenticated resources provided by the service. For GitHub
+        the 'login' variable is used.
+
+        :param access_token: a valid :class:`AccessToken`
+
+        .. versionadded:: 0.1.2
+
+        """
+        self.service.load_username(access_token)
+
+    def is_user_allowed(self, access_token):
+        return self.service.is_user_allowed(access_token)
+
+    def validate_token(self, access_token):
+        """Check if a bearer token given by an API client is valid through
+        the configured service.
+
+        :param access_token: an :class:`AccessToken` made of the bearer token
+        :returns: whether the token is valid
+        :rtype: :class:`bool`
+
+        .. versionadded:: 0.2.3
+
+        """
+        return self.service.validate_token(access_token)
+
+    def request_access_token(self, redirect_uri, code):
+        """Requests an access token.
+
+        :param redirect_uri: ``redirect_uri`` that was passed to
+                             :meth:`make_authorize_url`
+        :type redirect_uri: :class:`basestring`
+        :param code: verification code that authorize endpoint provides
+        :type code: :class:`code`
+        :returns: access token and additional data
+        :rtype: :class:`AccessToken`
+
+        """
+        form = {'code': code,
+                'client_id': self.client_id,
+                'client_secret': self.client_secret,
+                'redirect_uri': redirect_uri,
+                'grant_type': 'authorization_code'}
+        request = urllib2.Request(self.service.access_token_endpoint,
+                                  data=urlencode(form).encode('utf-8'))
+        u = self.urlopen(request)
+        try:
+            m = u.info()
+            try:
+                # Python 2
+                content_type = m.gettype()
+            except AttributeError:
+                # Python 3
+                content_type = m.get_content_type()
+            if content_type == 'application/json':
+                data = json.load(u)
+            else:
+                data = dict(
+                    (k.decode('utf-8')
+                     if not isinstance(k, str) and isinstance(k, bytes)
+                     else k, v)
+                    for k, v in urlparse.parse_qs(u.read()).items()
+                )
+        finally:
+            u.close()
+        access_token = AccessToken(data)
+        access_token.client = self
+        return access_token
+
+    def wsgi_middleware(self, *args, **kwargs):
+        """Wraps a WSGI application."""
+        return WSGIMiddleware(self, *args, **kwargs)
+
+
+class AccessToken(dict):
+    """Dictionary that contains access token. It always has ``'access_token'``
+    key.
+
+    """
+
+    #: (:class:`Client`) The client that requested the token.  Requests
+    #: made by :meth:`get` and :meth:`post` go through its
+    #: :meth:`Client.urlopen()` if it is set.  It is not pickled into
+    #: the session.
+    #:
+    #: .. versionadded:: 0.2.3
+    client = None
+
+    # The verified claims of the user, taken by the service from
+    # the id_token or the userinfo/introspection response.  Like client,
+    # it is not pickled into the session.
+    _claims = None
+
+    def __init__(self, *args, **kwargs):
+        super(AccessToken, self).__init__(*args, **kwargs)
+        if 'access_token' not in self:
+            raise TypeError("'access_token' is required")
+
+    def __reduce__(self):
+        # Pickle only the token data, not the transient client.
+        return type(self), (dict(self),)
+
+    def _urlopen(self, request):
+        if self.client is None:
+            return urllib2.urlopen(request)
+        return self.client.urlopen(request)
+
+    @property
+    def access_token(self):
+        """(:class:`basestring`) Access token."""
+        access_token = self['access_token']
+        if isinstance(access_token, list):
+            return access_token[0]
+        return access_token
+
+    def get(self, url, headers={}):
+        """Requests ``url`` as ``GET``.
+
+        If the :attr:`client` has a :attr:`~Client.response_cache`,
+        the request is made conditionally, and an unchanged response is
+        served from the cache.  The cached response is also served without
+        any request while the :attr:`~Client.rate_limits` budget is low.
+
+        :param headers: additional headers
+        :type headers: :class:`collections.Mapping`
+
+        .. versionchanged:: 0.2.3
+           It uses :attr:`Client.response_cache` if available.
+
+        """
+        url += ('&' if '?' in url else '?') + 'access_token=' + self.access_token
+        request = urllib2.Request(url, headers=headers)
+        cache = self.client and self.client.response_cache
+        if cache is None:
+            return self._urlopen(request)
+        key = cache.key(url)
+        cached = cache.get(key)
+        if cached is not None:
+            body, cached_headers, etag, last_modified = cached
+            if self.client.rate_limits.is_low(url):
+                return urllib2.addinfourl(io.BytesIO(body), cached_headers,
+                                          url, 200)
+            if etag:
+                request.add_header('If-None-Match', etag)
+            if last_modified:
+                request.add_header('If-Modified-Since', last_modified)
+        try:
+            response = self._urlopen(request)
+        except urllib2.HTTPError as e:
+            if e.code == 304 and cached is not None:
+                return urllib2.addinfourl(io.BytesIO(body), cached_headers,
+                                          url, 200)
+            raise
+        try:
+            body = response.read()
+        finally:
+            response.close()
+        cache.set(key, body, response.info())
+        return urllib2.addinfourl(io.BytesIO(body), response.info(), url,
+                                  response.getcode())
+
+    def post(self, url, form={}, headers={}):
+        """Requests ``url`` as ``POST``.
+
+        :param form: form data
+        :type form: :class:`collections.Mapping`
+        :param headers: additional headers
+        :type headers: :class:`collections.Mapping`
+
+        """
+        form = dict(form)
+        form['access_token'] = self.access_token
+        request = urllib2.Request(url, data=form, headers=headers)
+        return self._urlopen(request)
+
+    def __str__(self):
+        return self.access_token
+
+    def __repr__(self):
+        cls = type(self)
+        repr_ = dict.__repr__(self)
+        return '{0}.{1}({2})'.format(cls.__module__, cls.__name__, repr_)
+
+
+# The value of the fields a projected session does not have
+_MISSING = object()
+
+
+class Session(Mapping):
+    """Compact read-only record of the fields of an :class:`AccessToken`
+    that :class:`WSGIMiddleware` is configured to keep (see its
+    ``session_fields`` option).  It behaves like the :class:`AccessToken`
+    it is projected from: it is a mapping, and has :attr:`access_token`,
+    :meth:`get()` and :meth:`post()`.  The field names are shared by all
+    sessions of a middleware, so each session holds only its values.
+
+    :param index: the field names mapped to their positions
+    :type index: :class:`collections.Mapping`
+    :param values: the values of the fields
+    :type values: :class:`collections.Sequence`
+
+    .. versionadded:: 0.2.3
+
+    """
+
+    __slots__ = '_index', '_values', 'client'
+
+    def __init__(self, index, values):
+        self._index = index
+        self._values = list(values)
+        self.client = None
+
+    @classmethod
+    def project(cls, index, mapping):
+        """Makes a session with only the fields of the ``index`` from
+        the ``mapping``.
+
+        """
+        values = [_MISSING] * len(index)
+        for field, position in index.items():
+            if field in mapping:
+                values[position] = mapping[field]
+        return cls(index, values)
+
+    def __getitem__(self, key):
+        value = self._values[self._index[key]]
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        # Only fields of the projection can be set, e.g. the session id
+        self._values[self._index[key]] = value
+
+    def __iter__(self):
+        values = self._values
+        for field, position in self._index.items():
+            if values[position] is not _MISSING:
+                yield field
+
+    def __len__(self):
+        return sum(1 for value in self._values if value is not _MISSING)
+
+    def __contains__(self, key):
+        position = self._index.get(key)
+        return position is not None and self._values[position] is not _MISSING
+
+    access_token = AccessToken.__dict__['access_token']
+    get = AccessToken.__dict__['get']
+    post = AccessToken.__dict__['post']
+    _urlopen = AccessToken.__dict__['_urlopen']
+    __str__ = AccessToken.__dict__['__str__']
+
+    def __repr__(self):
+        cls = type(self)
+        repr_ = repr(dict((field, self[field]) for field in self))
+        return '{0}.{1}({2})'.format(cls.__module__, cls.__name__, repr_)
+
+
+class AdmissionController(object):
+    """Limits how many requests run a section concurrently, e.g., the blocking
+    token exchange of the OAuth callback.  Requests over the limit wait in
+    a bounded queue for up to ``queue_timeout`` seconds, and are rejected
+    when the queue is full or the timeout passes.
+
+    It is thread-safe.  Its counters can be read at any time through
+    :meth:`stats()`.
+
+    .. warning::
+
+       Requests waiting in the queue block the worker threads of
+       the server, which then cannot serve other requests, even ones with
+       a session.  Leave ``max_queue`` as 0 unless the server has far more
+       worker threads than ``max_concurrency + max_queue``, which have to
+       stay free for the rest of the traffic.
+
+    :param max_concurrency: the number of requests that run at once
+    :type max_concurrency: :class:`numbers.Integral`
+    :param max_queue: the number of requests that can wait for a slot.
+                      default is 0, i.e., excess requests are rejected
+                      immediately, which is recommended.  it has to be
+                      well below the number of worker threads
+    :type max_queue: :class:`numbers.Integral`
+    :param queue_timeout: seconds a request waits in the queue.
+                          default is 5
+    :type queue_timeout: :class:`numbers.Real`
+    :param retry_after: seconds suggested to rejected clients through
+                        the ``Retry-After`` header.  default is 5
+    :type retry_after: :class:`numbers.Integral`
+
+    .. versionadded:: 0.2.3
+
+    """
+
+    #: (:class:`numbers.Integral`) The number of requests that run at once.
+    max_concurrency = None
+
+    #: (:class:`numbers.Integral`) The number of requests that can wait.
+    max_queue = None
+
+    #: (:class:`numbers.Real`) Seconds a request waits in the queue.
+    queue_timeout = None
+
+    #: (:class:`numbers.Integral`) Seconds for the ``Retry-After`` header.
+    retry_after = None
+
+    def __init__(self, max_concurrency, max_queue=0, queue_timeout=5.0,
+                 retry_after=5):
+        for name, value in [('max_concurrency', max_concurrency),
+                            ('max_queue', max_queue),
+                            ('retry_after', retry_after)]:
+            if not isinstance(value, numbers.Integral):
+                raise TypeError('{0} must be an integer, not {1!r}'.format(
+                    name, value
+                ))
+        if max_concurrency < 1:
+            raise ValueError('max_concurrency must be greater than 0, not ' +
+                             repr(max_concurrency))
+        elif max_queue < 0:
+            raise ValueError('max_queue must not be negative, not ' +
+                             repr(max_queue))
+        if not isinstance(queue_timeout, numbers.Real):
+            raise TypeError('queue_timeout must be a number, not ' +
+                            repr(queue_timeout))
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._condition = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._admitted = 0
+        self._rejected = 0
+        self._timed_out = 0
+
+    def acquire(self):
+        """Takes a slot, waiting in the queue if needed.
+
+        :returns: :const:`True` if a slot is taken, or :const:`False` if
+                  the request is rejected.  Only when it returns
+                  :const:`True` :meth:`release()` has to be called
+        :rtype: :class:`bool`
+
+        """
+        with self._condition:
+            if self._active < self.max_concurrency:
+                self._active += 1
+                self._admitted += 1
+                return True
+            elif self._waiting >= self.max_queue:
+                self._rejected += 1
+                return False
+            self._waiting += 1
+            try:
+                deadline = _clock() + self.queue_timeout
+                while self._active >= self.max_concurrency:
+                    remaining = deadline - _clock()
+                    if remaining <= 0:
+                        self._rejected += 1
+                        self._timed_out += 1
+                        return False
+                    self._condition.wait(remaining)
+                self._active += 1
+                self._admitted += 1
+                return True
+            finally:
+                self._waiting -= 1
+
+    def release(self):
+        """Gives back the slot taken by :meth:`acquire()`."""
+        with self._condition:
+            self._active -= 1
+            self._condition.notify()
+
+    def stats(self):
+        """Returns the current counters:
+
+        ``'active'``
+           The number of requests running now.
+
+        ``'waiting'``
+           The queue depth, i.e., the number of requests waiting now.
+
+        ``'admitted'``
+           The total number of requests that took a slot.
+
+        ``'rejected'``
+           The total number of rejected requests, including timed out ones.
+
+        ``'timed_out'``
+           The total number of requests rejected after waiting in the queue.
+
+        :rtype: :class:`dict`
+
+        """
+        with self._condition:
+            return {'active': self._active,
+                    'waiting': self._waiting,
+                    'admitted': self._admitted,
+                    'rejected': self._rejected,
+                    'timed_out': self._timed_out}
+
+
+class TokenCache(object):
+    """Thread-safe in-memory cache of validated bearer tokens, so that
+    API clients don't need a validation round trip per request.  Tokens
+    are keyed by their SHA-256 digest, so the cache holds no token in
+    plain text.  Invalid tokens are cached as well, for a shorter time.
+
+    :param ttl: seconds to keep a valid token.  default is 300
+    :type ttl: :class:`numbers.Real`
+    :param negative_ttl: seconds to keep an invalid token.  default is 30
+    :type negative_ttl: :class:`numbers.Real`
+    :param max_size: the maximum number of entries.  the oldest entries
+                     are evicted first.  default is 10000
+    :type max_size: :class:`numbers.Integral`
+
+    .. versionadded:: 0.2.3
+
+    """
+
+    #: (:class:`numbers.Real`) Seconds to keep a valid token.
+    ttl = None
+
+    #: (:class:`numbers.Real`) Seconds to keep an invalid token.
+    negative_ttl = None
+
+    #: (:class:`numbers.Integral`) The maximum number of entries.
+    max_size = None
+
+    def __init__(self, ttl=300, negative_ttl=30, max_size=10000):
+        if not isinstance(ttl, numbers.Real):
+            raise TypeError('ttl must be a number, not ' + repr(ttl))
+        elif not isinstance(negative_ttl, numbers.Real):
+            raise TypeError('negative_ttl must be a number, not ' +
+                            repr(negative_ttl))
+        elif not isinstance(max_size, numbers.Integral):
+            raise TypeError('max_size must be an integer, not ' +
+                            repr(max_size))
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    @staticmethod
+    def key(token):
+        """Makes the cache key of the ``token``.
+
+        :param token: the bearer token
+        :type token: :class:`basestring`
+        :rtype: :class:`bytes`
+
+        """
+        if not isinstance(token, bytes):
+            token = token.encode('utf-8')
+        return hashlib.sha256(token).digest()
+
+    def get(self, key, default=None):
+        """Gets the cached value of the ``key``, or ``default`` if it is
+        not cached or has expired.
+
+        """
+        with self._lock:
+            try:
+                expires_at, value = self._entries[key]
+            except KeyError:
+                return default
+            if expires_at <= _clock():
+                del self._entries[key]
+                return default
+            return value
+
+    def set(self, key, value, valid=True):
+        """Caches the ``value`` of the ``key`` for :attr:`ttl` seconds, or
+        for :attr:`negative_ttl` seconds if it is not ``valid``.
+
+        """
+        expires_at = _clock() + (self.ttl if valid else self.negative_ttl)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = expires_at, value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RevocationList(object):
+    """The set of revoked session ids, checked on every request.  Lookups
+    first go through a Bloom filter, so that a session that is not revoked
+    (nearly every session) is usually cleared by testing a bit or two,
+    and only possible hits are confirmed with the exact set.
+
+    If ``path`` is given, the filter and the list of revoked ids are kept in
+    the file, and the filter is memory-mapped so that every worker process
+    sharing the file sees revocations immediately.  Writes are serialized
+    with :func:`fcntl.flock()` where available.  A list made before
+    the server forks workers, e.g., in a preloaded application, opens
+    the file again in each worker on its first use, so that workers don't
+    share the file offset and the lock.  The file is tied to
+    the ``capacity`` and ``error_rate``; remove it to change them.
+
+    An in-memory list is not shared, so that a session revoked by
+    a worker process is still accepted by the others.  Use a file
+    ``path`` if the server runs several worker processes.
+
+    Revoked ids are never forgotten: the exact set in memory and the log
+    in the file grow with every revocation.  Since the ids of expired
+    sessions need not be kept, remove the file (and restart the workers)
+    from time to time, e.g., when the secret key is rotated or after
+    the maximum session age has passed.
+
+    :param capacity: the expected number of revoked sessions.  the false
+                     positive rate grows beyond it.  default is 1000000
+    :type capacity: :class:`numbers.Integral`
+    :param error_rate: the false positive rate of the filter at
+                       ``capacity``.  default is 0.001
+    :type error_rate: :class:`numbers.Real`
+    :param path: an optional file path to share revocations between
+                 processes
+    :type path: :class:`basestring`
+
+    .. versionadded:: 0.2.3
+
+    """
+
+    _MAGIC = b'WSGIOA2R'
+    _HEADER = struct.Struct('>8sQI')
+
+    #: (:class:`numbers.Integral`) The number of bits of the filter.
+    size = None
+
+    #: (:class:`numbers.Integral`) The number of bits tested per lookup.
+    hash_count = None
+
+    #: (:class:`basestring`) The file path, or :const:`None` if it is kept
+    #: in memory only.
+    path = None
+
+    def __init__(self, capacity=1000000, error_rate=0.001, path=None):
+        if not isinstance(capacity, numbers.Integral):
+            raise TypeError('capacity must be an integer, not ' +
+                            repr(capacity))
+        elif capacity < 1:
+            raise ValueError('capacity must be greater than 0, not ' +
+                             repr(capacity))
+        elif not (isinstance(error_rate, numbers.Real) and
+                  0 < error_rate < 1):
+            raise ValueError('error_rate must be between 0 and 1, not ' +
+                             repr(error_rate))
+        size = -capacity * math.log(error_rate) / math.log(2) ** 2
+        self.size = int(math.ceil(size / 8)) * 8
+        self.hash_count = max(1, int(round(
+            float(self.size) / capacity * math.log(2)
+        )))
+        self.path = path
+        self._lock = threading.Lock()
+        self._revoked = set()
+        self._file = None
+        self._pid = os.getpid()
+        if path is None:
+            self._offset = 0
+            self._bits = bytearray(self.size // 8)
+            self._get_byte = self._bits.__getitem__
+            self._set_byte = self._bits.__setitem__
+        else:
+            self._open(path)
+
+    def _open(self, path):
+        import mmap
+        header = self._HEADER.pack(self._MAGIC, self.size, self.hash_count)
+        self._offset = len(header)
+        self._log_start = self._offset + self.size // 8
+        # Appends go to the end of the file even if another process has
+        # just appended, and reads don't move the offset
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+        self._file = os.fdopen(fd, 'r+b', 0)
+        with self._file_lock():
+            if os.fstat(fd).st_size == 0:
+                os.write(fd, header)
+                os.ftruncate(fd, self._log_start)
+                compatible = True
+            else:
+                compatible = _pread(fd, len(header), 0) == header
+            if compatible:
+                bits = mmap.mmap(fd, self._log_start)
+        if not compatible:
+            self._file.close()
+            raise ValueError('{0} is not a revocation list of the same '
+                             'capacity and error_rate'.format(path))
+        self._bits = bits
+        if bytes is str:
+            # Python 2's mmap items are 1-character strings
+            self._get_byte = lambda i: ord(bits[i])
+
+            def set_byte(i, value):
+                bits[i] = chr(value)
+            self._set_byte = set_byte
+        else:
+            self._get_byte = bits.__getitem__
+            self._set_byte = bits.__setitem__
+        self._log_offset = self._log_start
+        self._sync()
+
+    def _file_lock(self):
+        return _FileLock(self._file)
+
+    def _check_pid(self):
+        """Opens the file again if the process has forked since it was
+        opened, because the forked processes would otherwise share
+        the file description, and :func:`fcntl.flock()` doesn't lock
+        them out of each other.
+
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with _fork_lock:
+            if self._pid == pid:
+                return
+            # The lock may have been held by a thread that doesn't exist
+            # in this process
+            self._lock = threading.Lock()
+            self._bits.close()
+            self._file.close()
+            self._open(self.path)
+            self._pid = pid
+
+    def _sync(self):
+        """Reads session ids revoked by other processes since the last
+        sync from the file.
+
+        """
+        fd = self._file.fileno()
+        chunks = []
+        offset = self._log_offset
+        while True:
+            chunk = _pread(fd, 65536, offset)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            offset += len(chunk)
+        data = b''.join(chunks)
+        end = data.rfind(b'\n') + 1
+        if end:
+            for session_id in data[:end].splitlines():
+                self._revoked.add(session_id.decode('ascii'))
+            self._log_offset += end
+
+    def _hashes(self, session_id):
+        # Session ids are 128-bit random hex digits, so they are used as is
+        # instead of being hashed again
+        value = None
+        if len(session_id) == 32:
+            try:
+                value = int(session_id, 16)
+            except ValueError:
+                pass
+        if value is None:
+            digest = hashlib.sha1(session_id.encode('utf-8')).hexdigest()
+            value = int(digest[:32], 16)
+        return value & 0xffffffffffffffff, (value >> 64) | 1
+
+    def add(self, session_id):
+        """Revokes the ``session_id``.
+
+        :param session_id: the session id to revoke
+        :type session_id: :class:`basestring`
+
+        """
+        if not isinstance(session_id, basestring):
+            raise TypeError('session_id must be a string, not ' +
+                            repr(session_id))
+        elif not session_id.isalnum():
+            raise ValueError('session_id must be alphanumeric, not ' +
+                             repr(session_id))
+        if self._file is None:
+            with self._lock:
+                self._revoked.add(session_id)
+                self._set_bits(session_id)
+            return
+        self._check_pid()
+        with self._lock:
+            with self._file_lock():
+                # A single write to a file opened with O_APPEND, so that
+                # it cannot overwrite lines appended by other processes
+                os.write(self._file.fileno(),
+                         session_id.encode('ascii') + b'\n')
+                self._sync()
+                # Bits are read-modify-written on the shared map, so they
+                # have to be set under the lock other processes take as well
+                self._set_bits(session_id)
+
+    def _set_bits(self, session_id):
+        h1, h2 = self._hashes(session_id)
+        size = self.size
+        for i in range(self.hash_count):
+            position = (h1 + i * h2) % size
+            index = self._offset + (position >> 3)
+            self._set_byte(index, self._get_byte(index) | 1 << (position & 7))
+
+    def __contains__(self, session_id):
+        if self._file is not None:
+            self._check_pid()
+        h1, h2 = self._hashes(session_id)
+        size = self.size
+        offset = self._offset
+        get_byte = self._get_byte
+        for i in range(self.hash_count):
+            position = (h1 + i * h2) % size
+            if not get_byte(offset + (position >> 3)) & 1 << (position & 7):
+                return False
+        # Probably revoked; confirm with the exact set
+        if session_id in self._revoked:
+            return True
+        elif self._file is None:
+            return False
+        with self._lock:
+            self._sync()
+        return session_id in self._revoked
+
+    def __len__(self):
+        return len(self._revoked)
+
+
+# Serializes reopening files after fork
+_fork_lock = threading.Lock()
+
+
+def _pread(fd, size, offset):
+    """Reads up to ``size`` bytes at the ``offset`` of the ``fd`` without
+    moving the file offset where :func:`os.pread()` is available.
+
+    """
+    try:
+        pread = os.pread
+    except AttributeError:
+        # Python 2; the file description is not shared once reopened
+        # after fork, so that seeking it is safe
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+    return pread(fd, size, offset)
+
+
+class _FileLock(object):
+    """Exclusive :func:`fcntl.flock()` on the ``file`` as a context
+    manager.  It does nothing on platforms without :mod:`fcntl`.
+
+    """
+
+    def __init__(self, file):
+        self.file = file
+
+    def __enter__(self):
+        try:
+            import fcntl
+        except ImportError:
+            self.fcntl = None
+        else:
+            self.fcntl = fcntl
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.fcntl is not None:
+            self.fcntl.flock(self.file.fileno(), self.fcntl.LOCK_UN)
+
+
+# The branches of WSGIMiddleware a request can take by the route of its path
+_ROUTE_BRANCHES = {
+    'forbidden': frozenset(['forbidden']),
+    'logout': frozenset(['logout']),
+    'callback': frozenset(['callback']),
+    'login': frozenset(['authenticated', 'redirect', 'unauthorized']),
+    'unprotected': frozenset(['unprotected']),
+}
+
+
+class RequestProfiler(object):
+    """Profiles a sampled fraction of the requests to
+    :class:`WSGIMiddleware`, and writes a :mod:`cProfile` dump per
+    request into a directory, which can be loaded by :mod:`pstats`.
+    Requests that are not sampled cost only a random number.
+
+    Dumps are named ``<time>-<pid>-<branch>-<seq>.prof``, where the branch
+    is one of :attr:`BRANCHES`.  When the dumps in the directory exceed
+    ``max_bytes`` in total, the oldest ones are removed.  The directory
+    can be shared between worker processes.
+
+    Only the middleware itself is profiled, i.e., the part until it
+    returns the response iterable, which includes the wrapped application
+    call but not the iteration of its response.
+
+    :param directory: the directory to write dumps into.  it is created
+                      if it does not exist
+    :type directory: :class:`basestring`
+    :param rate: the fraction of requests to profile, from 0 to 1.
+                 default is 0.01
+    :type rate: :class:`numbers.Real`
+    :param branches: the branches to profile, e.g., ``['callback']``.
+                     requests whose path leads to other branches are not
+                     profiled at all.  requests to
+                     :attr:`~WSGIMiddleware.login_path` can take one of
+                     ``'authenticated'``, ``'redirect'`` and
+                     ``'unauthorized'``, which is known only after they
+                     are handled, so that they still pay for profiling if
+                     any of the three is selected, and are not written if
+                     they took another.  by default, all branches are
+    :type branches: :class:`collections.Iterable`
+    :param max_bytes: the maximum total size of the dumps in bytes.
+                      default is 64 MiB
+    :type max_bytes: :class:`numbers.Integral`
+
+    .. versionadded:: 0.2.3
+
+    """
+
+    #: (:class:`frozenset`) The branches of :class:`WSGIMiddleware`:
+    #:
+    #: ``'callback'``
+    #:    The OAuth callback, i.e., the access token exchange.
+    #: ``'authenticated'``
+    #:    A request with a valid session passed through to the application.
+    #: ``'redirect'``
+    #:    A request without a valid session redirected to the provider.
+    #: ``'unauthorized'``
+    #:    A request with an invalid, forbidden or unverifiable bearer token.
+    #: ``'unprotected'``
+    #:    A request out of :attr:`WSGIMiddleware.login_path`, or to
+    #:    the error page.
+    #: ``'forbidden'``
+    #:    A request to :attr:`WSGIMiddleware.forbidden_path`.
+    #: ``'logout'``
+    #:    A request to :attr:`WSGIMiddleware.logout_path`.
+    BRANCHES = frozenset(['callback', 'authenticated', 'redirect',
+                          'unauthorized', 'unprotected', 'forbidden',
+                          'logout'])
+
+    #: (:class:`basestring`) The directory to write dumps into.
+    directory = None
+
+    #: (:class:`numbers.Real`) The fraction of requests to profile.
+    rate = None
+
+    #: (:class:`frozenset`) The branches to profile.
+    branches = None
+
+    #: (:class:`numbers.Integral`) The maximum total size of the dumps.
+    max_bytes = None
+
+    def __init__(self, directory, rate=0.01, branches=None,
+                 max_bytes=64 * 1024 * 1024):
+        if not isinstance(directory, basestring):
+            raise TypeError('directory must be a string, not ' +
+                            repr(directory))
+        elif not isinstance(rate, numbers.Real):
+            raise TypeError('rate must be a number, not ' + repr(rate))
+        elif not 0 <= rate <= 1:
+            raise ValueError('rate must be between 0 and 1, not ' +
+                             repr(rate))
+        elif not isinstance(max_bytes, numbers.Integral):
+            raise TypeError('max_bytes must be an integer, not ' +
+                            repr(max_bytes))
+        if branches is None:
+            branches = self.BRANCHES
+        elif isinstance(branches, basestring):
+            raise TypeError('branches must be a list of strings, not ' +
+                            repr(branches))
+        else:
+            branches = frozenset(branches)
+            unknown = branches - self.BRANCHES
+            if unknown:
+                raise ValueError('unknown branches: ' +
+                                 ', '.join(sorted(unknown)))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.rate = rate
+        self.branches = branches
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._sequence = 0
+
+    def sample(self, branches=None):
+        """Decides whether to profile a request.
+
+        :param branches: the branches the request can take.  if none of
+                         them is profiled, the request is not sampled
+        :type branches: :class:`collections.Set`
+        :rtype: :class:`bool`
+
+        """
+        if branches is not None and self.branches.isdisjoint(branches):
+            return False
+        return random.random() < self.rate
 
-        :param access_token: a valid :class:`AccessToken`
+    def profile(self, function, environ, start_response):
+        """Calls the ``function``, which returns a pair of the branch and
+        the response like :meth:`WSGIMiddleware.respond()`, under
+        the profiler, and writes the dump if the branch is profiled.
 
-        .. versionadded:: 0.1.2
+        :returns: the response
 
         """
-        self.service.load_username(access_token)
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is active, e.g., for a concurrent request
+            return function(environ, start_response)[1]
+        try:
+            branch, response = function(environ, start_response)
+        finally:
+            profiler.disable()
+        if branch in self.branches:
+            try:
+                self.dump(profiler, branch)
+            except EnvironmentError:
+                # Profiling never fails the request
+                pass
+        return response
 
-    def is_user_allowed(self, access_token):
-        return self.service.is_user_allowed(access_token)
+    def dump(self, profiler, branch):
+        """Writes the dump of the ``profiler`` and removes the oldest
+        dumps over :attr:`max_bytes`.
 
-    def request_access_token(self, redirect_uri, code):
-        """Requests an access token.
+        :param profiler: the finished profiler
+        :type profiler: :class:`cProfile.Profile`
+        :param branch: the branch of the profiled request
+        :type branch: :class:`basestring`
+        :returns: the path of the written dump
+        :rtype: :class:`basestring`
 
-        :param redirect_uri: ``redirect_uri`` that was passed to
-                             :meth:`make_authorize_url`
-        :type redirect_uri: :class:`basestring`
-        :param code: verification code that authorize endpoint provides
-        :type code: :class:`code`
-        :returns: access token and additional data
-        :rtype: :class:`AccessToken`
+        """
+        import marshal
+        profiler.create_stats()
+        data = marshal.dumps(profiler.stats)
+        with self._lock:
+            self._sequence += 1
+            sequence = self._sequence
+        filename = '{0:.6f}-{1}-{2}-{3}.prof'.format(
+            time.time(), os.getpid(), branch, sequence
+        )
+        path = os.path.join(self.directory, filename)
+        _write_file_atomically(path, data)
+        self.rotate()
+        return path
+
+    def rotate(self):
+        """Removes the oldest dumps until their total size is at most
+        :attr:`max_bytes`.
 
         """
-        form = {'code': code,
-                'client_id': self.client_id,
-                'client_secret': self.client_secret,
-                'redirect_uri': redirect_uri,
-                'grant_type': 'authorization_code'}
-        u = urllib2.urlopen(self.service.access_token_endpoint,
-                            data=urlencode(form).encode('utf-8'))
-        m = u.info()
-        try:
-            # Python 2
-            content_type = m.gettype()
-        except AttributeError:
-            # Python 3
-            content_type = m.get_content_type()
-        if content_type == 'application/json':
-            data = json.load(u)
-        else:
-            data = dict(
-                (k.decode('utf-8')
-                 if not isinstance(k, str) and isinstance(k, bytes)
-                 else k, v)
-                for k, v in urlparse.parse_qs(u.read()).items()
-            )
-        u.close()
-        return AccessToken(data)
+        dumps = []
+        total = 0
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.prof'):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Removed by another process
+                continue
+            dumps.append((stat.st_mtime, filename, stat.st_size, path))
+            total += stat.st_size
+        dumps.sort()
+        for _, _, size, path in dumps:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
 
-    def wsgi_middleware(self, *args, **kwargs):
-        """Wraps a WSGI application."""
-        return WSGIMiddleware(self, *args, **kwargs)
 
+# The session cookie envelope: a fixed-width header of the version,
+# the issued-at and expires-at times (in seconds since the epoch, 0 means no
+# expiry), and the session id, followed by the HMAC signature of the header
+# and the payload, and the payload (a pickled session in unpadded urlsafe
+# base64).  The times are checked before the payload is even decoded.
+_ENVELOPE_VERSION = '2'
+_ENVELOPE_HEADER_SIZE = 53
+_ENVELOPE_SIZE = _ENVELOPE_HEADER_SIZE + 40
 
-class AccessToken(dict):
-    """Dictionary that contains access token. It always has ``'access_token'``
-    key.
+
+def _sign(secret, value):
+    return hmac.new(secret, value, hashlib.sha1).hexdigest()
+
+
+def _read_envelope(value):
+    """Reads the header of the session cookie ``value``.
+
+    :returns: a triple of the issued-at time, the expires-at time, and
+              the session id, or :const:`None` if it is malformed
 
     """
+    if len(value) <= _ENVELOPE_SIZE or value[0] != _ENVELOPE_VERSION:
+        return None
+    try:
+        issued_at = int(value[1:11])
+        expires_at = int(value[11:21])
+    except ValueError:
+        return None
+    return issued_at, expires_at, value[21:_ENVELOPE_HEADER_SIZE]
 
-    def __init__(self, *args, **kwargs):
-        super(AccessToken, self).__init__(*args, **kwargs)
-        if 'access_token' not in self:
-            raise TypeError("'access_token' is required")
 
-    @property
-    def access_token(self):
-        """(:class:`basestring`) Access token."""
-        access_token = self['access_token']
-        if isinstance(access_token, list):
-            return access_token[0]
-        return access_token
+def _verify_envelope(sign, value):
+    """Whether the session cookie ``value`` is signed by the ``sign``
+    function, e.g., :meth:`WSGIMiddleware.sign()`.
 
-    def get(self, url, headers={}):
-        """Requests ``url`` as ``GET``.
+    """
+    try:
+        signed = (value[:_ENVELOPE_HEADER_SIZE] +
+                  value[_ENVELOPE_SIZE:]).encode('ascii')
+        sig = value[_ENVELOPE_HEADER_SIZE:_ENVELOPE_SIZE].encode('ascii')
+    except UnicodeError:
+        return False
+    return _compare_digest(sign(signed).encode('ascii'), sig)
 
-        :param headers: additional headers
-        :type headers: :class:`collections.Mapping`
 
-        """
-        url += ('&' if '?' in url else '?') + 'access_token=' + self.access_token
-        request = urllib2.Request(url, headers=headers)
-        return urllib2.urlopen(request)
+def _load_payload(value):
+    """Unpickles the payload of the session cookie ``value``, which has to
+    be verified first.  Projected sessions are left packed.
 
-    def post(self, url, form={}, headers={}):
-        """Requests ``url`` as ``POST``.
+    :returns: the session, or :const:`None` if it cannot be decoded
 
-        :param form: form data
-        :type form: :class:`collections.Mapping`
-        :param headers: additional headers
-        :type headers: :class:`collections.Mapping`
+    """
+    try:
+        return pickle.loads(_b64url_decode(value[_ENVELOPE_SIZE:]))
+    except (binascii.Error, pickle.UnpicklingError, TypeError, ValueError):
+        return None
 
-        """
-        form = dict(form)
-        form['access_token'] = self.access_token
-        request = urllib2.Request(url, data=form, headers=headers)
-        return urllib2.urlopen(request)
 
-    def __str__(self):
-        return self.access_token
+def _make_session_layout(session_fields, set_remote_user):
+    """Makes the layout of projected sessions: the fields, the field names
+    mapped to their positions, and the checksum of the fields.
 
-    def __repr__(self):
-        cls = type(self)
-        repr_ = dict.__repr__(self)
-        return '{0}.{1}({2})'.format(cls.__module__, cls.__name__, repr_)
+    """
+    required = ['access_token', 'session_id']
+    if set_remote_user:
+        required.append('username')
+    fields = []
+    for field in list(session_fields) + required:
+        if field not in fields:
+            fields.append(field)
+    index = dict((f, i) for i, f in enumerate(fields))
+    # Cookies made with other fields are not loaded
+    checksum = binascii.crc32(','.join(fields).encode('utf-8')) & 0xffffffff
+    return tuple(fields), index, checksum
+
+
+def _unpack_session(packed, index, checksum):
+    """Makes a :class:`Session` of the ``packed`` projected session.
+
+    :returns: the session, or :const:`None` if it was packed with another
+              layout
+
+    """
+    if len(packed) != 3 or packed[0] != checksum:
+        return None
+    present, present_values = packed[1:]
+    present_values = iter(present_values)
+    values = [next(present_values) if present & (1 << i) else _MISSING
+              for i in range(len(index))]
+    return Session(index, values)
 
 
 class WSGIMiddleware(object):
@@ -439,6 +3231,83 @@ class WSGIMiddleware(object):
                         application is protected.  To override the default
                         path see the :attr:`login_path` option.
     :type login_path: :class:`basestring`
+    :param error_path: The path users are redirected to when the provider
+                       cannot be reached, e.g., it times out or its circuit
+                       is open.  Requests to this path are always passed
+                       through to the protected application.  By default,
+                       users are redirected to ``forbidden_path`` instead.
+    :type error_path: :class:`basestring`
+    :param admission_control: Limits concurrent OAuth callbacks, i.e.,
+                              blocking token exchanges.  Callbacks over
+                              the limit get ``503 Service Unavailable``
+                              with ``Retry-After``.  Requests with a session
+                              are never limited, but they can still wait
+                              for a worker thread that is held by
+                              a callback in the queue of the controller,
+                              so keep its ``max_queue`` at 0 or low.
+    :type admission_control: :class:`AdmissionController`
+    :param bearer: Set to True to accept ``Authorization: Bearer`` headers
+                   from API clients that cannot follow redirects.  Tokens
+                   are validated by :meth:`Service.validate_token()` and
+                   exposed as ``environ['wsgioauth2.session']`` like
+                   cookie sessions.  Requests with an invalid token get
+                   ``401 Unauthorized`` instead of a redirect.  The service
+                   has to be able to validate tokens (see
+                   :attr:`Service.can_validate_tokens`) and to tell whether
+                   they are issued to the client (see
+                   :attr:`Service.can_check_token_audience`)
+    :type bearer: :class:`bool`
+    :param bearer_any_audience: Set to True to use ``bearer`` with
+                                a service that cannot tell whether tokens
+                                are issued to the client, i.e., to accept
+                                tokens the provider issued to any other
+                                application as well
+    :type bearer_any_audience: :class:`bool`
+    :param bearer_cache: The cache of validated bearer tokens.  By default,
+                         a :class:`TokenCache` with its default options
+                         is used
+    :type bearer_cache: :class:`TokenCache`
+    :param logout_path: The path that ends the session.  The session id is
+                        added to ``revocation_list``, the cookie is cleared,
+                        and the user is redirected to the local path given
+                        by the ``next`` query parameter, or ``/``.
+    :type logout_path: :class:`basestring`
+    :param revocation_list: The revoked session ids, checked on every
+                            request.  By default, an in-memory
+                            :class:`RevocationList` is used if
+                            ``logout_path`` is set.  It is not shared
+                            between worker processes, so that a logged out
+                            session is still accepted by other workers;
+                            use one with a file ``path`` if the server
+                            runs several processes.  A :exc:`RuntimeWarning`
+                            is emitted otherwise
+    :type revocation_list: :class:`RevocationList`
+    :param max_session_age: The maximum age of sessions in seconds, enforced
+                            by the server regardless of the cookie's
+                            ``expires`` attribute.  By default, sessions
+                            expire only when the access token does
+                            (``expires_in``), if ever
+    :type max_session_age: :class:`numbers.Integral`
+    :param session_fields: The fields of the :class:`AccessToken` to keep
+                           in sessions, e.g., ``['access_token', 'username',
+                           'expires_in', 'refresh_token']``.  Sessions
+                           become compact :class:`Session` records, which
+                           makes cookies smaller.  ``'access_token'``,
+                           ``'session_id'``, and ``'username'`` (if
+                           ``set_remote_user`` is set) are always kept.
+                           By default, the whole :class:`AccessToken` is
+                           kept
+    :type session_fields: :class:`collections.Iterable` of
+                          :class:`basestring`
+    :param profiler: Profiles a sampled fraction of requests.  It costs
+                     nothing if not set
+    :type profiler: :class:`RequestProfiler`
+
+    .. versionadded:: 0.2.3
+       The ``error_path``, ``admission_control``, ``bearer``,
+       ``bearer_cache``, ``bearer_any_audience``, ``logout_path``,
+       ``revocation_list``, ``max_session_age``, ``session_fields`` and
+       ``profiler`` options.
 
     .. versionadded:: 0.1.4
        The ``login_path`` option.
@@ -487,6 +3356,67 @@ class WSGIMiddleware(object):
     #: .. versionadded:: 0.1.4
     login_path = None
 
+    #: (:class:`basestring`) The path users are redirected to when
+    #: the provider cannot be reached.  :const:`None` means
+    #: :attr:`forbidden_path` is used instead.
+    #:
+    #: .. versionadded:: 0.2.3
+    error_path = None
+
+    #: (:class:`AdmissionController`) Limits concurrent OAuth callbacks.
+    #: Its :meth:`~AdmissionController.stats()` tells the queue depth and
+    #: how many callbacks were rejected.
+    #:
+    #: .. versionadded:: 0.2.3
+    admission_control = None
+
+    #: (:class:`bool`) Whether ``Authorization: Bearer`` headers are accepted.
+    #:
+    #: .. versionadded:: 0.2.3
+    bearer = None
+
+    #: (:class:`TokenCache`) The cache of validated bearer tokens.
+    #:
+    #: .. versionadded:: 0.2.3
+    bearer_cache = None
+
+    #: (:class:`basestring`) The path that ends the session.
+    #:
+    #: .. versionadded:: 0.2.3
+    logout_path = None
+
+    #: (:class:`RevocationList`) The revoked session ids.
+    #:
+    #: .. versionadded:: 0.2.3
+    revocation_list = None
+
+    #: (:class:`numbers.Integral`) The maximum age of sessions in seconds.
+    #:
+    #: .. versionadded:: 0.2.3
+    max_session_age = None
+
+    #: (:class:`tuple`) The fields of the :class:`AccessToken` to keep in
+    #: sessions, or :const:`None` to keep the whole :class:`AccessToken`.
+    #:
+    #: .. versionadded:: 0.2.3
+    session_fields = None
+
+    #: (:class:`RequestProfiler`) Profiles a sampled fraction of requests.
+    #:
+    #: .. versionadded:: 0.2.3
+    profiler = None
+
+    #: (:class:`numbers.Integral`) The maximum number of hosts whose
+    #: redirect urls are kept.  Hosts come from the ``Host`` header, which
+    #: clients can set to anything, so the cache has to be capped.  Once it
+    #: is full, urls of other hosts are computed on every request; requests
+    #: with junk hosts can fill it first, and then even legitimate hosts
+    #: are not cached.  Putting a proxy that checks ``Host`` in front of
+    #: the application prevents that.
+    #:
+    #: .. versionadded:: 0.2.3
+    max_cached_hosts = 64
+
     #: (:class:`basestring`) The cookie name to be used for maintaining
     #: the user session.
     cookie = None
@@ -494,7 +3424,11 @@ class WSGIMiddleware(object):
     def __init__(self, client, application, secret,
                  path=None, cookie=DEFAULT_COOKIE, set_remote_user=False,
                  forbidden_path=None, forbidden_passthrough=False,
-                 login_path=None):
+                 login_path=None, error_path=None, admission_control=None,
+                 bearer=False, bearer_cache=None, logout_path=None,
+                 revocation_list=None, max_session_age=None,
+                 session_fields=None, profiler=None,
+                 bearer_any_audience=False):
         if not isinstance(client, Client):
             raise TypeError('client must be a wsgioauth2.Client instance, '
                             'not ' + repr(client))
@@ -513,6 +3447,47 @@ class WSGIMiddleware(object):
                 isinstance(login_path, basestring)):
             raise TypeError('login_path must be a string, not ' +
                             repr(path))
+        if not (error_path is None or isinstance(error_path, basestring)):
+            raise TypeError('error_path must be a string, not ' +
+                            repr(error_path))
+        if not (admission_control is None or
+                isinstance(admission_control, AdmissionController)):
+            raise TypeError('admission_control must be a wsgioauth2.'
+                            'AdmissionController instance, not ' +
+                            repr(admission_control))
+        if bearer and not client.service.can_validate_tokens:
+            raise ValueError(
+                'bearer cannot be used with {0!r}; it needs an introspection '
+                'or userinfo endpoint to validate tokens'.format(
+                    client.service
+                )
+            )
+        elif bearer and not bearer_any_audience and \
+                not client.service.can_check_token_audience:
+            raise ValueError(
+                'bearer with {0!r} would accept tokens issued to other '
+                'applications, since it cannot tell whether they are '
+                'issued to this client; set bearer_any_audience=True to '
+                'accept them anyway'.format(client.service)
+            )
+        if not (bearer_cache is None or isinstance(bearer_cache, TokenCache)):
+            raise TypeError('bearer_cache must be a wsgioauth2.TokenCache '
+                            'instance, not ' + repr(bearer_cache))
+        if not (logout_path is None or isinstance(logout_path, basestring)):
+            raise TypeError('logout_path must be a string, not ' +
+                            repr(logout_path))
+        if not (revocation_list is None or
+                isinstance(revocation_list, RevocationList)):
+            raise TypeError('revocation_list must be a wsgioauth2.'
+                            'RevocationList instance, not ' +
+                            repr(revocation_list))
+        if not (max_session_age is None or
+                isinstance(max_session_age, numbers.Integral)):
+            raise TypeError('max_session_age must be an integer, not ' +
+                            repr(max_session_age))
+        if isinstance(session_fields, basestring):
+            raise TypeError('session_fields must be a list of strings, not ' +
+                            repr(session_fields))
         if not isinstance(cookie, basestring):
             raise TypeError('cookie must be a string, not ' + repr(cookie))
         self.client = client
@@ -537,8 +3512,98 @@ class WSGIMiddleware(object):
         if not login_path.startswith('/'):
             login_path = '/' + login_path
         self.login_path = login_path
+        # error_path must start with a / to avoid relative links
+        if not (error_path is None or error_path.startswith('/')):
+            error_path = '/' + error_path
+        self.error_path = error_path
+        self.admission_control = admission_control
+        self.bearer = bearer
+        if bearer and bearer_cache is None:
+            bearer_cache = TokenCache()
+        self.bearer_cache = bearer_cache
+        # logout_path must start with a / to ensure proper matching
+        if not (logout_path is None or logout_path.startswith('/')):
+            logout_path = '/' + logout_path
+        self.logout_path = logout_path
+        if logout_path is not None and revocation_list is None:
+            revocation_list = RevocationList()
+        self.revocation_list = revocation_list
+        self._warn_unshared_revocations = (revocation_list is not None and
+                                           revocation_list.path is None)
+        self.max_session_age = max_session_age
         self.cookie = cookie
         self.set_remote_user = set_remote_user
+        if session_fields is not None:
+            session_fields, self._session_index, self._session_layout = \
+                _make_session_layout(session_fields, set_remote_user)
+        self.session_fields = session_fields
+        self.profiler = profiler
+        self._host_urls = {}
+
+    def host_urls(self, scheme, host):
+        """Gets the urls of the callback, the forbidden page, and the error
+        page on the ``host``.  They are cached for up to
+        :attr:`max_cached_hosts` hosts.
+
+        :param scheme: ``'http'`` or ``'https'``
+        :type scheme: :class:`basestring`
+        :param host: the host, i.e., the ``Host`` header
+        :type host: :class:`basestring`
+        :returns: a triple of the redirect uri, the forbidden uri, and
+                  the error uri
+        :rtype: :class:`tuple`
+
+        .. versionadded:: 0.2.3
+
+        """
+        key = scheme, host
+        try:
+            return self._host_urls[key]
+        except KeyError:
+            pass
+        url = '{0}://{1}/'.format(scheme, host)
+        redirect_uri = urlparse.urljoin(url, self.path)
+        forbidden_uri = urlparse.urljoin(url, self.forbidden_path)
+        if self.error_path is None:
+            error_uri = forbidden_uri
+        else:
+            error_uri = urlparse.urljoin(url, self.error_path)
+        urls = redirect_uri, forbidden_uri, error_uri
+        if len(self._host_urls) < self.max_cached_hosts:
+            self._host_urls[key] = urls
+        return urls
+
+    def warmup(self, hosts=(), connections=1):
+        """Primes the middleware before it serves requests, e.g., in
+        a post-fork hook of the server.  It primes the client by
+        :meth:`Client.warmup()`, and computes the urls of the ``hosts``
+        by :meth:`host_urls()`.
+
+        :param hosts: the base urls the application is served on, e.g.,
+                      ``['https://example.com']``
+        :type hosts: :class:`collections.Iterable`
+        :param connections: the number of connections to open per
+                            provider host.  default is 1
+        :type connections: :class:`numbers.Integral`
+        :returns: what :meth:`Client.warmup()` returns, and ``'hosts'``
+                  (the hosts whose urls were computed)
+        :rtype: :class:`dict`
+
+        .. versionadded:: 0.2.3
+
+        """
+        started_at = _clock()
+        result = self.client.warmup(connections)
+        if isinstance(hosts, basestring):
+            hosts = [hosts]
+        primed = []
+        for url in hosts:
+            parsed = urlparse.urlparse(url)
+            self.host_urls(parsed.scheme, parsed.netloc)
+            primed.append(parsed.netloc)
+        result['hosts'] = primed
+        result['elapsed'] = _clock() - started_at
+        return result
 
     def sign(self, value):
         """Generate signature of the given ``value``.
@@ -548,13 +3613,147 @@ class WSGIMiddleware(object):
         """
         if not isinstance(value, bytes):
             raise TypeError('expected bytes, not ' + repr(value))
-        return hmac.new(self.secret, value, hashlib.sha1).hexdigest()
+        return _sign(self.secret, value)
+
+    def project_session(self, session):
+        """Projects the ``session`` to :attr:`session_fields` if configured.
+
+        :param session: the session
+        :type session: :class:`AccessToken`
+        :returns: the projected :class:`Session`, or the ``session`` as is
+                  if :attr:`session_fields` is not configured
+
+        .. versionadded:: 0.2.3
+
+        """
+        if self.session_fields is None or isinstance(session, Session):
+            return session
+        return Session.project(self._session_index, session)
+
+    def dump_session(self, session):
+        """Signs and serializes the ``session`` into a cookie value.
+        A new session id is assigned to it.  It expires when the access
+        token does (``expires_in``) or when it reaches
+        :attr:`max_session_age`, whichever comes first.
+
+        :param session: the session to serialize
+        :type session: :class:`AccessToken`
+        :returns: a pair of the cookie value and the time when the session
+                  expires in seconds since the epoch (0 if it never does)
+        :rtype: :class:`tuple`
+
+        .. versionadded:: 0.2.3
+
+        """
+        issued_at = int(time.time())
+        expires_at = 0
+        if 'expires_in' in session:
+            expires_in = session['expires_in']
+            if isinstance(expires_in, list):
+                expires_in = expires_in[0]
+            expires_at = issued_at + int(expires_in)
+        if self.max_session_age is not None:
+            max_expires_at = issued_at + self.max_session_age
+            if not expires_at or max_expires_at < expires_at:
+                expires_at = max_expires_at
+        session_id = binascii.hexlify(os.urandom(16)).decode('ascii')
+        header = '{0}{1:010d}{2:010d}{3}'.format(
+            _ENVELOPE_VERSION, issued_at, expires_at, session_id
+        )
+        session = self.project_session(session)
+        if isinstance(session, Session):
+            # Only the values of the present fields are stored, in order
+            values = list(session._values)
+            # The session id is in the envelope header, not in the payload
+            values[self._session_index['session_id']] = _MISSING
+            present = 0
+            for position, value in enumerate(values):
+                if value is not _MISSING:
+                    present |= 1 << position
+            session = (self._session_layout, present,
+                       tuple(v for v in values if v is not _MISSING))
+        payload = base64.urlsafe_b64encode(pickle.dumps(session))
+        payload = payload.rstrip(b'=').decode('ascii')
+        sig = self.sign((header + payload).encode('ascii'))
+        return header + sig + payload, expires_at
+
+    def load_session(self, value):
+        """Verifies and loads a session from the cookie ``value``.  Expired
+        sessions are rejected by the signed times in the envelope header
+        before the signature is checked and the payload is decoded.
+
+        :param value: the cookie value
+        :type value: :class:`basestring`
+        :returns: the session, or :const:`None` if the cookie is invalid,
+                  expired or revoked
+        :rtype: :class:`AccessToken`, :class:`Session`
+
+        .. versionadded:: 0.2.3
+
+        """
+        header = _read_envelope(value)
+        if header is None:
+            return None
+        issued_at, expires_at, session_id = header
+        now = time.time()
+        if expires_at and expires_at <= now:
+            return None
+        max_session_age = self.max_session_age
+        if max_session_age is not None and \
+                issued_at + max_session_age <= now:
+            return None
+        if not _verify_envelope(self.sign, value):
+            return None
+        revocation_list = self.revocation_list
+        if revocation_list is not None and session_id in revocation_list:
+            return None
+        session = _load_payload(value)
+        if isinstance(session, tuple):
+            if self.session_fields is None:
+                return None
+            session = _unpack_session(session, self._session_index,
+                                      self._session_layout)
+        if session is None:
+            return None
+        session['session_id'] = session_id
+        return session
+
+    def logout(self, environ, start_response):
+        """Ends the session of the request: revokes it, clears the cookie,
+        and redirects to the local path given by the ``next`` query
+        parameter.
+
+        .. versionadded:: 0.2.3
+
+        """
+        cookie_dict = Cookie.SimpleCookie()
+        cookie_dict.load(environ.get('HTTP_COOKIE', ''))
+        if self.cookie in cookie_dict:
+            session = self.load_session(cookie_dict[self.cookie].value)
+            if session is not None and 'session_id' in session:
+                self.revocation_list.add(session['session_id'])
+        query_dict = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+        next_path = query_dict.get('next', ['/'])[0]
+        # Only local paths, to avoid an open redirect
+        if not next_path.startswith('/') or next_path.startswith('//'):
+            next_path = '/'
+        url = '{0}://{1}{2}'.format(environ.get('wsgi.url_scheme', 'http'),
+                                    environ.get('HTTP_HOST', ''),
+                                    next_path)
+        set_cookie = Cookie.SimpleCookie()
+        set_cookie[self.cookie] = ''
+        set_cookie[self.cookie]['path'] = '/'
+        set_cookie[self.cookie]['max-age'] = 0
+        set_cookie[self.cookie]['expires'] = 'Thu, 01 Jan 1970 00:00:00 GMT'
+        set_cookie = set_cookie[self.cookie].OutputString()
+        return self.redirect(url, start_response,
+                             headers={'Set-Cookie': set_cookie})
 
     def redirect(self, url, start_response, headers={}):
         h = {'Content-Type': 'text/html; charset=utf-8', 'Location': url}
         h.update(headers)
         start_response('307 Temporary Redirect', list(h.items()))
-        e_url = html_escape(url).encode('iso-8859-1')
+        e_url = html.escape(url).encode('iso-8859-1')
         yield b'<!DOCTYPE html>'
         yield b'<html><head><meta charset="utf-8">'
         yield b'<meta http-equiv="refresh" content="0; url='
@@ -580,115 +3779,583 @@ class WSGIMiddleware(object):
         yield b'</pre>'
         yield b'</p></body></html>'
 
+    def service_unavailable(self, start_response, retry_after):
+        """Respond with an HTTP 503 Service Unavailable status.
+
+        .. versionadded:: 0.2.3
+
+        """
+        h = [('Content-Type', 'text/html; charset=utf-8'),
+             ('Retry-After', str(retry_after))]
+        start_response('503 Service Unavailable', h)
+        yield b'<!DOCTYPE html>'
+        yield b'<html><head><meta charset="utf-8">'
+        yield b'<title>Service Unavailable</title></head>'
+        yield b'<body><p>503 Service Unavailable - '
+        yield b'Authentication is temporarily unavailable.  '
+        yield b'Please try again later.'
+        yield b'</p></body></html>'
+
+    def unauthorized(self, start_response):
+        """Respond with an HTTP 401 Unauthorized status for an invalid
+        bearer token.
+
+        .. versionadded:: 0.2.3
+
+        """
+        h = [('Content-Type', 'text/html; charset=utf-8'),
+             ('WWW-Authenticate', 'Bearer error="invalid_token"')]
+        start_response('401 Unauthorized', h)
+        yield b'<!DOCTYPE html>'
+        yield b'<html><head><meta charset="utf-8">'
+        yield b'<title>Unauthorized</title></head>'
+        yield b'<body><p>401 Unauthorized - '
+        yield b'The access token is invalid or has expired.'
+        yield b'</p></body></html>'
+
+    def authenticate_bearer(self, token):
+        """Validates a bearer ``token`` of an API client, using
+        :attr:`bearer_cache` if possible.
+
+        :param token: the bearer token
+        :type token: :class:`basestring`
+        :returns: the session if the token is valid and the user is
+                  allowed, :const:`False` if the token is valid but
+                  the user is not allowed, or :const:`None` if the token
+                  is invalid, or it has no username to set
+                  ``REMOTE_USER`` to while ``set_remote_user`` is set
+        :rtype: :class:`AccessToken`
+
+        .. versionadded:: 0.2.3
+
+        """
+        cache = self.bearer_cache
+        key = cache.key(token)
+        session = cache.get(key, cache)
+        if session is not cache:
+            return session
+        session = AccessToken(access_token=token)
+        session.client = self.client
+        if not self.client.validate_token(session) or \
+                self.set_remote_user and 'username' not in session:
+            session = None
+        elif not self.client.is_user_allowed(session):
+            session = False
+        if session:
+            session = self.project_session(session)
+        cache.set(key, session, valid=bool(session))
+        return session
+
     def __call__(self, environ, start_response):
-        url = '{0}://{1}{2}'.format(environ.get('wsgi.url_scheme', 'http'),
-                                    environ.get('HTTP_HOST', ''),
+        profiler = self.profiler
+        if profiler is not None and profiler.sample(
+                _ROUTE_BRANCHES[self._route(environ['PATH_INFO'])]):
+            return profiler.profile(self.respond, environ, start_response)
+        return self.respond(environ, start_response)[1]
+
+    def _route(self, path):
+        if path.startswith(self.forbidden_path):
+            return 'forbidden'
+        elif self.logout_path is not None and path == self.logout_path:
+            return 'logout'
+        elif self.error_path is not None and \
+                path.startswith(self.error_path):
+            return 'unprotected'
+        elif path.startswith(self.path):
+            return 'callback'
+        elif path.startswith(self.login_path):
+            return 'login'
+        return 'unprotected'
+
+    def respond(self, environ, start_response):
+        """Does what :meth:`__call__()` does, but returns the branch
+        the request took as well.
+
+        :returns: a pair of the branch (one of
+                  :attr:`RequestProfiler.BRANCHES`) and the response
+        :rtype: :class:`tuple`
+
+        .. versionadded:: 0.2.3
+
+        """
+        if self._warn_unshared_revocations and \
+                environ.get('wsgi.multiprocess'):
+            self._warn_unshared_revocations = False
+            warnings.warn('the revocation_list is kept in memory, so that '
+                          'sessions logged out in a worker process are '
+                          'still accepted by the others; give it a path '
+                          'to share it', RuntimeWarning)
+        scheme = environ.get('wsgi.url_scheme', 'http')
+        host = environ.get('HTTP_HOST', '')
+        url = '{0}://{1}{2}'.format(scheme, host,
                                     environ.get('PATH_INFO', '/'))
-        redirect_uri = urlparse.urljoin(url, self.path)
-        forbidden_uri = urlparse.urljoin(url, self.forbidden_path)
+        redirect_uri, forbidden_uri, error_uri = self.host_urls(scheme, host)
         query_string = environ.get('QUERY_STRING', '')
         if query_string:
             url += '?' + query_string
         cookie_dict = Cookie.SimpleCookie()
         cookie_dict.load(environ.get('HTTP_COOKIE', ''))
         query_dict = urlparse.parse_qs(query_string)
-        path = environ['PATH_INFO']
-        if path.startswith(self.forbidden_path):
+        route = self._route(environ['PATH_INFO'])
+        if route == 'forbidden':
             if self.forbidden_passthrough:
                 # Pass the forbidden request through to the app
-                return self.application(environ, start_response)
-            return self.forbidden(start_response)
+                return 'forbidden', self.application(environ, start_response)
+            return 'forbidden', self.forbidden(start_response)
 
-        elif path.startswith(self.path):
+        elif route == 'logout':
+            return 'logout', self.logout(environ, start_response)
+
+        elif route == 'callback':
             code = query_dict.get('code')
             if not code:
                 # No code in URL - forbidden
-                return self.redirect(forbidden_uri, start_response)
+                return 'callback', self.redirect(forbidden_uri, start_response)
 
+            admission_control = self.admission_control
+            if admission_control is not None and \
+                    not admission_control.acquire():
+                return 'callback', self.service_unavailable(
+                    start_response, admission_control.retry_after
+                )
             try:
-                code = code[0]
-                access_token = self.client.request_access_token(redirect_uri,
-                                                                code)
-            except TypeError:
-                # No access token provided - forbidden
-                return self.redirect(forbidden_uri, start_response)
-
-            # Load the username now so it's in the session cookie
-            if self.set_remote_user:
-                self.client.load_username(access_token)
-
-            # Check if the authenticated user is allowed
-            if not self.client.is_user_allowed(access_token):
-                return self.redirect(forbidden_uri, start_response)
-
-            session = pickle.dumps(access_token)
-            sig = self.sign(session)
-            signed_session = sig.encode('ascii') + b',' + session
-            signed_session = base64.urlsafe_b64encode(signed_session)
+                try:
+                    code = code[0]
+                    access_token = self.client.request_access_token(
+                        redirect_uri, code
+                    )
+                except TypeError:
+                    # No access token provided - forbidden
+                    return 'callback', self.redirect(forbidden_uri,
+                                                     start_response)
+
+                # Load the username now so it's in the session cookie
+                if self.set_remote_user:
+                    self.client.load_username(access_token)
+
+                # Check if the authenticated user is allowed
+                allowed = self.client.is_user_allowed(access_token)
+            except IDTokenError:
+                return 'callback', self.redirect(forbidden_uri, start_response)
+            except (EnvironmentError, httplib.HTTPException) as e:
+                # The provider rejected the request (e.g. the code expired),
+                # or it is unreachable, slow, or its circuit is open
+                if _is_transient(e):
+                    return 'callback', self.redirect(error_uri, start_response)
+                return 'callback', self.redirect(forbidden_uri, start_response)
+            finally:
+                if admission_control is not None:
+                    admission_control.release()
+            if not allowed:
+                return 'callback', self.redirect(forbidden_uri, start_response)
+
+            signed_session, expires_at = self.dump_session(access_token)
             set_cookie = Cookie.SimpleCookie()
-            set_cookie[self.cookie] = signed_session.decode('ascii')
+            set_cookie[self.cookie] = signed_session
             set_cookie[self.cookie]['path'] = '/'
-            if 'expires_in' in access_token:
-                expires_in = int(access_token['expires_in'])
+            if expires_at:
+                expires_in = expires_at - int(time.time())
                 set_cookie[self.cookie]['expires'] = expires_in
             set_cookie = set_cookie[self.cookie].OutputString()
-            return self.redirect(query_dict.get('state', [''])[0],
-                                 start_response,
-                                 headers={'Set-Cookie': set_cookie})
-        elif path.startswith(self.login_path):
-            if self.cookie in cookie_dict:
-                session = cookie_dict[self.cookie].value
+            return 'callback', self.redirect(
+                query_dict.get('state', [''])[0],
+                start_response,
+                headers={'Set-Cookie': set_cookie}
+            )
+        elif route == 'login':
+            authorization = environ.get('HTTP_AUTHORIZATION', '')
+            if self.bearer and authorization[:7].lower() == 'bearer ':
                 try:
-                    session = base64.urlsafe_b64decode(session)
-                except binascii.Error:
-                    session = b''
-                if b',' in session:
-                    sig, val = session.split(b',', 1)
-                    if sig.decode('ascii') == self.sign(val):
-                        try:
-                            session = pickle.loads(val)
-                        except (pickle.UnpicklingError, ValueError):
-                            session = None
-                    else:
-                        session = None
-                else:
+                    session = self.authenticate_bearer(
+                        authorization[7:].strip()
+                    )
+                except (EnvironmentError, httplib.HTTPException) as e:
+                    retry_after = getattr(e, 'retry_after', None) or 5
+                    retry_after = max(1, int(math.ceil(retry_after)))
+                    return 'unauthorized', self.service_unavailable(
+                        start_response, retry_after
+                    )
+                except IDTokenError:
                     session = None
+                if session is None:
+                    return 'unauthorized', self.unauthorized(start_response)
+                elif session is False:
+                    return 'unauthorized', self.forbidden(start_response)
+            elif self.cookie in cookie_dict:
+                session = self.load_session(cookie_dict[self.cookie].value)
             else:
                 session = None
 
             if session is None:
-                return self.redirect(
+                return 'redirect', self.redirect(
                     self.client.make_authorize_url(redirect_uri, state=url),
                     start_response
                 )
             else:
                 environ = dict(environ)
+                session.client = self.client
                 environ['wsgioauth2.session'] = session
                 if self.set_remote_user and session['username']:
                     environ['REMOTE_USER'] = session['username']
+                return 'authenticated', self.application(environ,
+                                                         start_response)
+
+        return 'unprotected', self.application(environ, start_response)
+
+
+def _facebook():
+    return Service(
+        authorize_endpoint='https://www.facebook.com/dialog/oauth',
+        access_token_endpoint='https://graph.facebook.com/oauth/access_token'
+    )
+
+
+#: (:class:`dict`) The factories of the predefined services.
+PREDEFINED_SERVICES = {
+    'facebook': _facebook,
+    'google': GoogleService,
+    'github': GitHubService,
+}
+
+#: (:class:`basestring`) The entry point group third-party services are
+#: registered to.
+SERVICE_ENTRY_POINT_GROUP = 'wsgioauth2.services'
+
+_services = {}
+
+
+def _find_entry_point(group, name):
+    try:
+        from importlib import metadata
+    except ImportError:
+        try:
+            import pkg_resources
+        except ImportError:
+            return None
+        for entry_point in pkg_resources.iter_entry_points(group, name):
+            return entry_point
+        return None
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        entry_points = entry_points.select(group=group)
+    else:
+        entry_points = entry_points.get(group, ())
+    for entry_point in entry_points:
+        if entry_point.name == name:
+            return entry_point
+    return None
+
+
+def get_service(name):
+    """Gets the service of the ``name``, made on first use.  It is one of
+    the :data:`PREDEFINED_SERVICES`, or a third-party service registered
+    to the ``wsgioauth2.services`` entry point group, e.g.:
+
+    .. code-block:: ini
+
+       [options.entry_points]
+       wsgioauth2.services =
+           gitlab = wsgioauth2_gitlab:gitlab
+
+    The entry point refers to a :class:`Service` or a callable that
+    returns one.
+
+    :param name: the name of the service e.g. ``'github'``
+    :type name: :class:`basestring`
+    :returns: the service
+    :rtype: :class:`Service`
+    :raises LookupError: when there is no such service
+
+    .. versionadded:: 0.2.3
+
+    """
+    try:
+        return _services[name]
+    except KeyError:
+        pass
+    if name in PREDEFINED_SERVICES:
+        service = PREDEFINED_SERVICES[name]()
+    else:
+        entry_point = _find_entry_point(SERVICE_ENTRY_POINT_GROUP, name)
+        if entry_point is None:
+            raise LookupError('no such service: ' + repr(name))
+        service = entry_point.load()
+        if not isinstance(service, Service):
+            service = service()
+        if not isinstance(service, Service):
+            raise TypeError('the entry point {0!r} must refer to a wsgioauth2.'
+                            'Service, not {1!r}'.format(name, service))
+    # Another thread may have made it meanwhile
+    return _services.setdefault(name, service)
+
+
+def __getattr__(name):
+    # The predefined services are made on first access (PEP 562)
+    if name in PREDEFINED_SERVICES:
+        service = get_service(name)
+        globals()[name] = service
+        return service
+    raise AttributeError('module {0!r} has no attribute {1!r}'.format(
+        __name__, name
+    ))
+
+
+if sys.version_info < (3, 7):
+    # No module __getattr__(); make them now
+    for _name in PREDEFINED_SERVICES:
+        globals()[_name] = get_service(_name)
+    del _name
+
+
+class _CookieInspector(object):
+    """Finds session cookies in log lines, and reports whether each of them
+    is validly signed, whether it has expired, and whose it is, as
+    :class:`WSGIMiddleware` configured with the same options would.
+
+    """
+
+    #: (:class:`numbers.Integral`) The number of cookies whose verification
+    #: results are kept, since a session appears in many lines of a log.
+    cache_size = 10000
+
+    def __init__(self, secret, cookie=WSGIMiddleware.DEFAULT_COOKIE,
+                 session_fields=None, set_remote_user=False,
+                 max_session_age=None):
+        import re
+        self._hmac = hmac.new(secret, digestmod=hashlib.sha1)
+        # Cookie values are made of the urlsafe base64 alphabet
+        self.pattern = re.compile(
+            b'(?<![A-Za-z0-9_-])' + re.escape(cookie.encode('ascii')) +
+            b'=([A-Za-z0-9_-]+)'
+        )
+        self.layout = None
+        if session_fields is not None:
+            self.layout = _make_session_layout(session_fields,
+                                               set_remote_user)[1:]
+        self.max_session_age = max_session_age
+        self._verified = {}
+        self._encode = json.JSONEncoder(sort_keys=True).encode
+
+    def sign(self, value):
+        # Cheaper than hmac.new() for every cookie
+        h = self._hmac.copy()
+        h.update(value)
+        return h.hexdigest()
+
+    def verify(self, value):
+        """Verifies the signature of the cookie ``value`` and loads
+        the username of the session.
+
+        :returns: a pair of whether it is validly signed and the username
+        :rtype: :class:`tuple`
+
+        """
+        if not _verify_envelope(self.sign, value):
+            return False, None
+        # Only signed payloads are unpickled
+        session = _load_payload(value)
+        if isinstance(session, tuple):
+            session = self.layout and _unpack_session(session, *self.layout)
+        if session is not None and 'username' in session:
+            return True, session['username']
+        return True, None
+
+    def inspect(self, value, now):
+        """Inspects the cookie ``value``.
+
+        :returns: the report
+        :rtype: :class:`dict`
+
+        """
+        header = _read_envelope(value)
+        if header is None:
+            return {'status': 'malformed'}
+        issued_at, expires_at, session_id = header
+        try:
+            signed, username = self._verified[value]
+        except KeyError:
+            signed, username = self.verify(value)
+            if len(self._verified) >= self.cache_size:
+                self._verified.clear()
+            self._verified[value] = signed, username
+        if not signed:
+            status = 'bad_signature'
+        elif expires_at and expires_at <= now or \
+                self.max_session_age is not None and \
+                issued_at + self.max_session_age <= now:
+            status = 'expired'
+        else:
+            status = 'valid'
+        return {
+            'session_id': session_id,
+            'issued_at': issued_at,
+            'expires_at': expires_at or None,
+            'username': username,
+            'status': status,
+        }
+
+    def inspect_lines(self, batch):
+        """Inspects the cookies in the ``batch`` of lines.
+
+        :param batch: a triple of the source name, the number of the first
+                      line, and the lines
+        :type batch: :class:`tuple`
+        :returns: the reports as JSON lines
+        :rtype: :class:`list`
+
+        """
+        source, line_number, lines = batch
+        now = time.time()
+        reports = []
+        for line in lines:
+            for match in self.pattern.finditer(line):
+                report = self.inspect(match.group(1).decode('ascii'), now)
+                report['source'] = source
+                report['line'] = line_number
+                reports.append(self._encode(report))
+            line_number += 1
+        return reports
+
+
+_inspector = None
+
+
+def _start_inspector(*args):
+    global _inspector
+    _inspector = _CookieInspector(*args)
+
+
+def _inspect_lines(batch):
+    return _inspector.inspect_lines(batch)
+
+
+def _read_batches(paths, batch_size):
+    """Reads the lines of the files of the ``paths`` (``'-'`` means
+    the standard input) in batches, so that it runs in constant memory.
+
+    """
+    for path in paths:
+        if path == '-':
+            f = getattr(sys.stdin, 'buffer', sys.stdin)
+        elif path.endswith('.gz'):
+            import gzip
+            f = gzip.open(path, 'rb')
+        else:
+            f = open(path, 'rb')
+        try:
+            lines = []
+            line_number = 1
+            for line in f:
+                lines.append(line)
+                if len(lines) >= batch_size:
+                    yield path, line_number, lines
+                    line_number += len(lines)
+                    lines = []
+            if lines:
+                yield path, line_number, lines
+        finally:
+            if f is not getattr(sys.stdin, 'buffer', sys.stdin):
+                f.close()
+
+
+def main(argv=None):
+    """The command line interface, i.e., ``python -m wsgioauth2``.  Its
+    ``inspect`` command reads session cookies from access logs, and
+    prints a JSON line for each of them: ``source``, ``line``,
+    ``session_id``, ``issued_at``, ``expires_at``, ``username``, and
+    ``status`` (``valid``, ``expired``, ``bad_signature``, or
+    ``malformed``).  Cookies are verified in batches by a pool of worker
+    processes.  The secret is read from the :envvar:`WSGIOAUTH2_SECRET`
+    environment variable or the ``--secret-file``.
+
+    .. sourcecode:: console
+
+       $ export WSGIOAUTH2_SECRET='hmac*secret'
+       $ zcat access.log.gz | python -m wsgioauth2 inspect > cookies.jsonl
+
+    :param argv: the arguments.  by default, :data:`sys.argv` is used
+    :type argv: :class:`collections.Sequence`
+    :returns: the exit status
+    :rtype: :class:`numbers.Integral`
+
+    .. versionadded:: 0.2.3
+
+    """
+    import argparse
+    import multiprocessing
+    parser = argparse.ArgumentParser(
+        prog='python -m wsgioauth2',
+        description='Tools for wsgioauth2 session cookies.'
+    )
+    commands = parser.add_subparsers(dest='command')
+    inspect = commands.add_parser(
+        'inspect',
+        help='verify session cookies found in access logs',
+        description='Verifies session cookies found in access logs, and '
+                    'prints a JSON line for each of them.'
+    )
+    inspect.add_argument('files', metavar='FILE', nargs='*', default=['-'],
+                         help='log files to read, .gz ones decompressed.  '
+                              'by default, the standard input is read')
+    inspect.add_argument('--secret-file', metavar='FILE',
+                         help='the file of the secret key.  by default, '
+                              'the WSGIOAUTH2_SECRET environment variable '
+                              'is used')
+    inspect.add_argument('--cookie', default=WSGIMiddleware.DEFAULT_COOKIE,
+                         help='the cookie name [%(default)s]')
+    inspect.add_argument('--session-fields', metavar='FIELD,...',
+                         type=lambda fields: fields.split(','),
+                         help='the session_fields option of the middleware')
+    inspect.add_argument('--remote-user', action='store_true',
+                         help='the set_remote_user option of the middleware')
+    inspect.add_argument('--max-session-age', metavar='SECONDS', type=int,
+                         help='the max_session_age option of the middleware')
+    inspect.add_argument('-j', '--jobs', type=int,
+                         default=multiprocessing.cpu_count(),
+                         help='the number of worker processes [%(default)s]')
+    inspect.add_argument('--batch-size', metavar='LINES', type=int,
+                         default=10000,
+                         help='the lines per batch [%(default)s]')
+    args = parser.parse_args(argv)
+    if args.command != 'inspect':
+        parser.print_usage(sys.stderr)
+        return 2
+    if args.secret_file is not None:
+        with open(args.secret_file, 'rb') as f:
+            secret = f.read().rstrip(b'\r\n')
+    elif os.environ.get('WSGIOAUTH2_SECRET'):
+        secret = os.environ['WSGIOAUTH2_SECRET'].encode('utf-8')
+    else:
+        inspect.error('the secret key is required: set WSGIOAUTH2_SECRET '
+                      'or use --secret-file')
+    options = (secret, args.cookie, args.session_fields, args.remote_user,
+               args.max_session_age)
+    batches = _read_batches(args.files, max(1, args.batch_size))
+    output = sys.stdout
+    if args.jobs <= 1:
+        inspector = _CookieInspector(*options)
+        for batch in batches:
+            for report in inspector.inspect_lines(batch):
+                output.write(report + '\n')
+        return 0
+    pool = multiprocessing.Pool(args.jobs, _start_inspector, options)
+    try:
+        # Keep a few batches in flight, so that the input is read no faster
+        # than workers verify it, and reports are printed in order
+        pending = collections.deque()
+        for batch in batches:
+            pending.append(pool.apply_async(_inspect_lines, (batch,)))
+            if len(pending) >= args.jobs * 2:
+                for report in pending.popleft().get():
+                    output.write(report + '\n')
+        while pending:
+            for report in pending.popleft().get():
+                output.write(report + '\n')
+    finally:
+        pool.terminate()
+        pool.join()
+    return 0
+
 
-        return self.application(environ, start_response)
-
-
-#: (:class:`Service`) The predefined service for Facebook__.
-#:
-#: __ https://www.facebook.com/
-facebook = Service(
-    authorize_endpoint='https://www.facebook.com/dialog/oauth',
-    access_token_endpoint='https://graph.facebook.com/oauth/access_token'
-)
-
-#: (:class:`Service`) The predefined service for Google__.
-#:
-#: __ http://www.google.com/
-google = Service(
-    authorize_endpoint='https://accounts.google.com/o/oauth2/auth',
-    access_token_endpoint='https://accounts.google.com/o/oauth2/token'
-)
-
-#: (:class:`GitHubService`) The predefined service for GitHub__.
-#:
-#: .. versionadded:: 0.1.2
-#:
-#: __ https://github.com/
-github = GitHubService()
+if __name__ == '__main__':
+    sys.exit(main())